@@ -0,0 +1,78 @@
+'''
+Concurrent load test for the web app.
+
+Requests slow urls (e.g. recomputes) and fast urls (e.g. cached similars)
+together from many threads, then reports latency of each kind, to compare
+serving under WSGI (manage.py runserver) and ASGI (uvicorn web.asgi:application).
+
+Usage:
+    python loadtest.py <base url> <slow path> <fast path> [threads] [requests]
+e.g.
+    python loadtest.py http://localhost:8000 /recompute/12345/ /12345/ 32 200
+'''
+import sys
+import time
+import threading
+import urllib.request
+
+import numpy as np
+
+
+def timed_get(url):
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(url, timeout=300) as r:
+            r.read()
+            ok = r.status == 200
+    except Exception:
+        ok = False
+    return time.perf_counter() - start, ok
+
+
+def run(base, slow_path, fast_path, threads=32, requests=200):
+    # every fourth request is slow
+    urls = [(('slow', base + slow_path) if i % 4 == 0 else ('fast', base + fast_path))
+            for i in range(requests)]
+    results = {'slow': [], 'fast': []}
+    failures = {'slow': 0, 'fast': 0}
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not urls:
+                    return
+                kind, url = urls.pop()
+            t, ok = timed_get(url)
+            with lock:
+                if ok:
+                    results[kind].append(t)
+                else:
+                    failures[kind] += 1
+
+    start = time.perf_counter()
+    pool = [threading.Thread(target=worker) for _ in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    print('{} requests on {} threads in {:.1f}s ({:.1f}/s)'.format(
+        requests, threads, elapsed, requests / elapsed))
+    for kind in ('fast', 'slow'):
+        times = np.array(results[kind]) * 1000
+        if not len(times):
+            print('{}: no successful requests, {} failed'.format(kind, failures[kind]))
+            continue
+        print('{}: p50 {:8.1f}ms  p90 {:8.1f}ms  p99 {:8.1f}ms  max {:8.1f}ms  ({} ok, {} failed)'.format(
+            kind, np.percentile(times, 50), np.percentile(times, 90),
+            np.percentile(times, 99), times.max(), len(times), failures[kind]))
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if len(args) < 3:
+        print(__doc__)
+        sys.exit(1)
+    run(args[0], args[1], args[2], *[int(a) for a in args[3:5]])
@@ -0,0 +1,27 @@
+"""
+ASGI config for web project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+Serve with an ASGI server, e.g. ``uvicorn web.asgi:application``.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/3.1/howto/deployment/asgi/
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "web.settings")
+
+application = get_asgi_application()
+
+from yreweb.yre import constants
+from yreweb.yre.database import use_pool
+# async views run their database work in many threads at once
+use_pool(constants.DB_POOL_SIZE)
+
+if constants.WARM_ON_STARTUP:
+    # before this worker takes any traffic
+    from yreweb.yre.analysis import warm_cache
+    warm_cache()
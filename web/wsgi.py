@@ -14,3 +14,9 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "web.settings")
 
 application = get_wsgi_application()
+
+from yreweb.yre import constants
+if constants.WARM_ON_STARTUP:
+    # before this worker takes any traffic
+    from yreweb.yre.analysis import warm_cache
+    warm_cache()
@@ -3,3 +3,8 @@ from django.apps import AppConfig
 
 class YrewebConfig(AppConfig):
     name = 'yreweb'
+
+    def ready(self):
+        # requests made while serving pages go ahead of batch jobs
+        from .yre import ratelimit
+        ratelimit.set_priority(ratelimit.INTERACTIVE)
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from yreweb.yre import constants
+from yreweb.yre.analysis import warm_cache
+
+
+class Command(BaseCommand):
+    # in-process caches belong to this command, so what lasts is the
+    # on-disk previews. see WARM_ON_STARTUP for warming web workers.
+    help = 'Preloads previews of the most requested posts.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=constants.WARM_POSTS)
+        parser.add_argument('--no-download', action='store_true',
+                            help="don't download missing previews")
+
+    def handle(self, *args, **options):
+        warm_cache(options['limit'], download=not options['no_download'])
@@ -1,3 +1,179 @@
-from django.test import TestCase
+import os
+import tempfile
+import unittest
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from scipy import sparse
+from django.test import SimpleTestCase
+
+from .yre import constants, metrics, stats
+from .yre.database import Database
+from .yre.ratelimit import RateLimiter
+from .yre.remote import LocalApi
+from .yre.tagsim import TagIndex
+
+# a scratch postgres database to run against. posts with ids from
+# FIRST_ID are written to it, and deleted afterwards.
+TEST_DSN = os.environ.get('YRE_TEST_DSN')
+
+FIRST_ID = 900000000
+
+
+def make_post(id):
+    return {
+        'id': id, 'status': 'active', 'fav_count': 2, 'score': 1,
+        'rating': 's', 'created_at': {'s': 1500000000}, 'md5': str(id),
+        'file_url': 'full/{}.png'.format(id),
+        'sample_url': 'sample/{}.jpg'.format(id),
+        'preview_url': 'preview/{}.jpg'.format(id),
+        'tags': 'yre_test_tag yre_test_tag_{}'.format(id % 2),
+    }
+
+
+@unittest.skipUnless(TEST_DSN, 'set YRE_TEST_DSN to a scratch database')
+class LocalApiTests(SimpleTestCase):
+    '''
+    Crawls posts served by a LocalApi, without remote access.
+    '''
+    def setUp(self):
+        self.ids = list(range(FIRST_ID, FIRST_ID + 10))
+        self.api = LocalApi({id: make_post(id) for id in self.ids},
+                            {id: ['user_a', 'user_b'] for id in self.ids})
+        Database.api = self.api
+        Database.limiter = RateLimiter()
+        self.db = Database(TEST_DSN, read_dsn='')
+        self.db.init_db()
+        self.clean()
+
+    def tearDown(self):
+        self.clean()
+        Database.api = None
+        Database.limiter = None
+
+    def clean(self):
+        for table, column in [('posts', 'id'), ('post_tags', 'post_id'),
+                              ('post_favorites', 'post_id'),
+                              ('favorites_meta', 'post_id'),
+                              ('favorites_delta', 'post_id'),
+                              ('missing_posts', 'post_id')]:
+            self.db.c.execute('delete from {} where {} >= %s'.format(table, column),
+                              (FIRST_ID,))
+        self.db.c.execute("delete from tags where name like 'yre\\_test\\_tag%'")
+        self.db.conn.commit()
+        # the ids of the deleted tags would otherwise be reused
+        Database.tag_ids.clear()
+
+    def count_posts(self):
+        self.db.c.execute('select count(*) from posts where id >= %s', (FIRST_ID,))
+        return self.db.c.fetchall()[0][0]
+
+    def test_get_all_posts_parallel(self):
+        self.db.get_all_posts_parallel(ranges=3, before_id=self.ids[-1] + 1,
+                                       after_id=FIRST_ID)
+        self.assertEqual(self.count_posts(), len(self.ids))
+
+        self.db.c.execute('''select count from tags where name = 'yre_test_tag' ''')
+        self.assertEqual(self.db.c.fetchall()[0][0], len(self.ids))
+
+    def test_hydrate(self):
+        missing = self.ids[-1] + 1
+        posts, favs = self.db.hydrate(self.ids + [missing])
+        self.assertEqual((posts, favs), (len(self.ids), len(self.ids)))
+        # every post fits on one page; favorites are fetched one post at a time
+        self.assertEqual(self.api.requests,
+                         {'posts_page': 1, 'favorite_users': len(self.ids)})
+        self.assertTrue(self.db.is_known_missing(missing))
+
+        # hydrating again needs no requests
+        self.assertEqual(self.db.hydrate(self.ids), (0, 0))
+        self.assertEqual(self.api.requests['posts_page'], 1)
+
+
+class MetricsTests(SimpleTestCase):
+    def test_scores(self):
+        # 2 users in common, 4 favorites each
+        self.assertAlmostEqual(metrics.score('add_sim', 2, 4, 4)[()], 2/6)
+        self.assertAlmostEqual(metrics.score('mult_sim', 2, 4, 4)[()], 4/16)
+        self.assertAlmostEqual(metrics.score('cosine', 2, 4, 4)[()], 0.5)
+        self.assertAlmostEqual(metrics.score('lift', 2, 4, 4, total=16)[()], 2.0)
+        self.assertAlmostEqual(metrics.score('pmi', 2, 4, 4, total=16)[()], np.log(2))
+
+    def test_no_favorites(self):
+        # posts without favorites score 0, not nan
+        for metric in ['add_sim', 'mult_sim', 'cosine', 'shrunk_jaccard']:
+            self.assertEqual(metrics.score(metric, 0, 0, 0)[()], 0)
+
+    def test_unknown_metric(self):
+        with self.assertRaises(ValueError):
+            metrics.score('nonsense', 1, 1, 1)
+
+    def test_score_rows(self):
+        self.assertEqual(len(metrics.score_rows('add_sim', [])), 0)
+        rows = [(1, 2, 2, 0, 0, 4, 4), (1, 3, 1, 0, 0, None, 3)]
+        scores = metrics.score_rows('add_sim', rows)
+        np.testing.assert_allclose(scores, [2/6, 1/2])
+
+
+class DistributionTests(SimpleTestCase):
+    def test_distribution(self):
+        dist = stats.distribution([(1, 3), (2, 2), (5, 1)])
+        self.assertEqual(dist, {
+            'values': [1, 2, 5],
+            'counts': [3, 2, 1],
+            'cumulative_counts': [3, 5, 6],
+            'cumulative_totals': [3, 7, 12],
+        })
+
+    def test_empty(self):
+        dist = stats.distribution([])
+        self.assertEqual(dist['values'], [])
+        self.assertEqual(dist['cumulative_totals'], [])
+
+    def test_dense(self):
+        dist = stats.distribution([(1, 3), (3, 1), (9, 4)])
+        self.assertEqual(stats.dense(dist, 'counts', 4).tolist(), [0, 3, 0, 1, 0])
+
+
+class TagIndexTests(SimpleTestCase):
+    '''
+    Posts 1 and 2 share both their tags, post 3 shares one with them,
+    and tag 10, on every post, carries no weight.
+    '''
+    # too few posts for TAG_MAX_DF to leave any tags
+    @mock.patch.object(constants, 'TAG_MAX_DF', 1)
+    def setUp(self):
+        post_ids = [1, 2, 3, 4]
+        tag_ids = [10, 11, 12, 13]
+        tags = [[10, 11, 12], [10, 11, 12], [10, 11], [10, 13]]
+        rows = [i for i, t in enumerate(tags) for _ in t]
+        cols = [tag_ids.index(t) for post in tags for t in post]
+        matrix = sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.float32), (rows, cols)),
+            shape=(len(post_ids), len(tag_ids)))
+        self.index = TagIndex(post_ids, tag_ids, matrix)
+
+    def test_similar(self):
+        ids, scores = self.index.similar(1)
+        self.assertEqual(ids, [2, 3])
+        self.assertAlmostEqual(scores[0], 1, places=5)
+        self.assertLess(scores[1], scores[0])
+
+    def test_limit(self):
+        ids, scores = self.index.similar(1, n=1)
+        self.assertEqual(ids, [2])
+
+    def test_scores_for(self):
+        scores = self.index.scores_for(1, [2, 4, 99])
+        self.assertAlmostEqual(scores[0], 1, places=5)
+        self.assertEqual(scores[1:], [0, 0])
+
+    def test_unknown_post(self):
+        self.assertEqual(self.index.similar(99), ([], []))
+
+    def test_save_load(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'tags.npz')
+            self.index.save(path)
+            loaded = TagIndex.load(path)
+        self.assertEqual(loaded.similar(1), self.index.similar(1))
@@ -11,5 +11,9 @@ urlpatterns = [
          name='recompute_similar'),
     path('full/<int:source_id>/', views.recompute_full,
          name='recompute_full'),
-    path('subset/', views.subset, name='subset')
+    path('multi/<str:source_ids>/', views.multi_pics, name='multi_pics'),
+    path('user/<str:username>/', views.user_pics, name='user_pics'),
+    path('image/<int:post_id>/', views.preview_image, name='preview_image'),
+    path('subset/', views.subset, name='subset'),
+    path('stats/', views.stats_json, name='stats')
 ]
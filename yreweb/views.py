@@ -1,20 +1,35 @@
 from django.shortcuts import render
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, JsonResponse, FileResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from asgiref.sync import sync_to_async
 
-from .yre.analysis import get_n_similar
+from .yre.analysis import get_n_similar, recommend_for_user, compute_similar_multi
 from .yre.database import Database
 from .yre import constants
 from .yre import images
+from .yre import stats
+from .yre import metrics
 
+import os
 import time
 
+# the slow paths (database, computation, downloads) of async views run in
+# worker threads, so one process can hold many slow requests at once.
+def in_thread(f):
+    return sync_to_async(f, thread_sensitive=False)
+
 # Create your views here.
 def index(request):
     #redirect to example
     return HttpResponseRedirect('/{}/'.format(constants.EXAMPLE_POST_ID))
 
 def similar_list(request, source_id):
-    return(HttpResponse(str(get_n_similar(source_id))))
+    try:
+        metric = get_metric(request)
+    except ValueError as e:
+        return HttpResponse(str(e), status=400)
+    return(HttpResponse(str(get_n_similar(source_id, metric=metric))))
 
 def urls_list(request, source_id):
     similar_ids = get_n_similar(source_id)
@@ -22,54 +37,139 @@ def urls_list(request, source_id):
     urls = db.get_urls_for_ids(similar_ids)
     return(HttpResponse(str(urls)))
 
-def similar_pics(request, source_id,
-                 stale_time=constants.DEFAULT_STALE_TIME,
-                 full=False, source='local'):
-    start = time.time()
-    similar_ids = get_n_similar(source_id, stale_time, from_full=full)[:constants.SIMS_SHOWN]
-    print(similar_ids)
+def remote_urls(similar_ids):
     db = Database()
+    urls = db.get_urls_for_ids(similar_ids)
 
-    if source == 'remote':
-        urls = db.get_urls_for_ids(similar_ids)
+    urls_preview = []
+    for u in urls:
+        slicepoint = u.find('/data/')+len('/data/')
+        new_url = u[:slicepoint]
+        new_url += 'sample/'
+        new_url += u[slicepoint:]
+        urls_preview.append(new_url)
+    return urls
+
+async def render_similars(request, title, similar_ids, source='local', start=None):
+    if start is None:
+        start = time.time()
+    # 0 pads lists of fewer than SIM_PER_POST similars
+    similar_ids = [id for id in similar_ids if id]
 
-        urls_preview = []
-        for u in urls:
-            slicepoint = u.find('/data/')+len('/data/')
-            new_url = u[:slicepoint]
-            new_url += 'sample/'
-            new_url += u[slicepoint:]
-            urls_preview.append(new_url)
+    if source == 'remote':
+        urls = await in_thread(remote_urls)(similar_ids)
 
         e6prefix = 'http://localhost:6210/'#'https://e621.net/post/show/'
         e6urls = [e6prefix+str(id) for id in similar_ids]
 
         zipped = list(zip(similar_ids, urls, e6urls))
 
-        context = {'source': source_id, 'zipped': zipped}
-        print('response for {} took {}s'.format(source_id, time.time()-start))
+        context = {'source': title, 'zipped': zipped}
+        print('response for {} took {}s'.format(title, time.time()-start))
         return render(request, 'yreweb/response-remote.html', context)
 
     elif source == 'local':
-        names = [images.image_with_delay(id) for id in similar_ids]
-
+        # previews are fetched by the browser from preview_image, one per
+        # tile, so the page goes out before any of them is downloaded
         link_prefix = 'http://localhost:6210/'
         link_urls = [link_prefix+str(id) for id in similar_ids]
 
-        zipped = list(zip(similar_ids, names, link_urls))
+        zipped = list(zip(similar_ids, link_urls))
 
-        print('response for {} took {}s'.format(source_id, time.time()-start))
-        context = {'source': source_id, 'zipped': zipped}
+        print('response for {} took {}s'.format(title, time.time()-start))
+        context = {'source': title, 'zipped': zipped}
         return render(request, 'yreweb/response-local.html', context)
 
+def get_metric(request):
+    '''
+    Returns the similarity metric asked for with ?metric=, or None.
+    Raises ValueError for unknown metrics.
+    '''
+    metric = request.GET.get('metric')
+    if metric is not None and metric not in metrics.METRICS:
+        raise ValueError('Unknown metric. Use one of: {}.'.format(', '.join(metrics.METRICS)))
+    return metric
+
+def log_and_get_similar(source_id, stale_time, full, metric=None):
+    Database().log_access(source_id)
+    return get_n_similar(source_id, stale_time, from_full=full, metric=metric)
+
+async def similar_pics(request, source_id,
+                 stale_time=constants.DEFAULT_STALE_TIME,
+                 full=False, source='local'):
+    start = time.time()
+    try:
+        metric = get_metric(request)
+    except ValueError as e:
+        return HttpResponse(str(e), status=400)
+    similar_ids = await in_thread(log_and_get_similar)(source_id, stale_time, full, metric)
+    similar_ids = (similar_ids or [])[:constants.SIMS_SHOWN]
+    print(similar_ids)
+    return await render_similars(request, source_id, similar_ids, source, start)
 
-
-def recompute_similar(request, source_id):
-    return similar_pics(request, source_id, stale_time=0)
-
-def recompute_full(request, source_id):
-    return similar_pics(request, source_id, stale_time=0, full=True)
+async def multi_pics(request, source_ids, source='local'):
+    # source_ids is comma separated, as in /multi/123,456,789/
+    start = time.time()
+    seeds = [int(id) for id in source_ids.split(',') if id.strip().isdigit()]
+    if not seeds:
+        return HttpResponse('No post ids given.', status=400)
+    try:
+        metric = get_metric(request)
+    except ValueError as e:
+        return HttpResponse(str(e), status=400)
+    similar_ids = await in_thread(compute_similar_multi)(seeds, metric=metric)
+    return await render_similars(request, source_ids, similar_ids, source, start)
+
+async def user_pics(request, username, source='local'):
+    start = time.time()
+    similar_ids = await in_thread(recommend_for_user)(username)
+    return await render_similars(request, username, similar_ids, source, start)
+
+
+async def recompute_similar(request, source_id):
+    return await similar_pics(request, source_id, stale_time=0)
+
+async def recompute_full(request, source_id):
+    return await similar_pics(request, source_id, stale_time=0, full=True)
+
+def error_image(status):
+    response = FileResponse(open(images.error_path, 'rb'),
+                            content_type='image/jpeg', status=status)
+    response['Cache-Control'] = 'no-store'
+    return response
+
+async def preview_image(request, post_id):
+    '''
+    Serves a post's preview from the local cache, downloading it on a miss.
+    Answers conditional requests for cached previews with 304 Not Modified.
+    '''
+    if not post_id:
+        # padding in similars lists, not a post
+        return error_image(404)
+
+    path = images.local_path(post_id)
+    if not os.path.isfile(path):
+        await images.image_async(post_id)
+        if not os.path.isfile(path):
+            # unknown post, or the download failed. not cached, so it
+            # is tried again next time.
+            return error_image(404)
+
+    st = os.stat(path)
+    etag = quote_etag('{:x}-{:x}'.format(int(st.st_mtime), st.st_size))
+    last_modified = int(st.st_mtime)
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = FileResponse(open(path, 'rb'), content_type='image/jpeg')
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    response['Cache-Control'] = 'max-age={}'.format(constants.PREVIEW_MAX_AGE)
+    return response
 
 def subset(request):
     db = Database()
     return HttpResponse(db.update_favorites_subset())
+
+def stats_json(request):
+    return JsonResponse(stats.all_stats())
@@ -3,40 +3,90 @@ try:
     from .utilities import *
     from . import constants
     from . import images
+    from . import tagsim
+    from . import topk
+    from . import metrics
+    from .ratelimit import RateLimiter, default_limiter
 
 except ModuleNotFoundError:
     from database import Database
     from utilities import *
     import constants
     import images
+    import tagsim
+    import topk
+    import metrics
+    from ratelimit import RateLimiter, default_limiter
 
 import time
 import random
 import math
 import sys
 import itertools
+import multiprocessing
 from operator import itemgetter
 import psycopg2
+import numpy as np
 
 
+# source_id: (time cached, similar ids). see get_n_similar.
+_similar_cache = {}
 
 def get_n_similar(source_id,
                     stale_time=constants.DEFAULT_STALE_TIME,
-                    from_full=False):
+                    from_full=False,
+                    fav_change=constants.STALE_FAV_CHANGE,
+                    metric=None):
     '''
     Returns a list of the most similar posts to the source.
     Uses database to cache results.
+
+    Cached results are recomputed when the source's favorites changed by
+    more than fav_change (see Database.similars_dirty),
+    or when older than stale_time seconds, if given.
+    Results are also kept in memory for SIMILAR_CACHE_TTL seconds,
+    unless stale_time is 0.
+
+    A metric other than SYM_SIM_MODE (see metrics.METRICS) re-ranks the
+    source's stored sym_similarity pairs, computing them only if none exist.
     '''
+    if metric and metric != constants.SYM_SIM_MODE:
+        db = Database()
+        rows = db.select_n_similar(source_id, constants.SIM_PER_POST, metric)
+        if not rows or stale_time == 0:
+            top_n = get_n_similar(source_id, stale_time, from_full, fav_change)
+            rows = db.select_n_similar(source_id, constants.SIM_PER_POST, metric)
+            if not rows:
+                # e.g. scored by tags alone
+                return top_n
+        return [r[1] if r[0] == source_id else r[0] for r in rows]
 
     compute_print = True  # show table of statistics?
 
+    cached = _similar_cache.get(source_id)
+    if (cached and stale_time != 0 and
+            time.time() - cached[0] < constants.SIMILAR_CACHE_TTL):
+        return cached[1]
+
     print('Getting top similar for', source_id)
 
+    if constants.TOPK_FILE:
+        # a read-only snapshot; no staleness checks
+        top_n = topk.lookup(source_id)
+        if top_n:
+            return top_n
+
     # check if in db
     db = Database()
-    results = db.select_similars(source_id)
+    packed = db.select_similars_packed(source_id)
+
+    if packed is None:
+        # not packed (yet). try the row layout.
+        results = db.select_similars(source_id)
+        if len(results) >= constants.SIM_PER_POST:
+            packed = (min(x[1] for x in results), [x[2] for x in results])
 
-    if len(results) < constants.SIM_PER_POST:
+    if packed is None:
         # not yet in db. let's add it!
         print('Similars not in database ({}/{} expected found). Computing...'.format(
             len(results), constants.SIM_PER_POST
@@ -47,13 +97,12 @@ def get_n_similar(source_id,
 
     else:
         print('Found in database.')
-        result = [x[2] for x in results]
-        last_time = min(x[1] for x in results)
+        last_time, result = packed
         top_n = result[-constants.SIM_PER_POST:]
 
         age = time.time() - last_time
 
-        if age > stale_time:
+        if stale_time is not None and age > stale_time:
             # this hasn't been updated in a while.
             print('Cache stale ({} old, threshhold {}). Fetching...'.format(
                 seconds_to_dhms(age), seconds_to_dhms(stale_time)
@@ -62,15 +111,63 @@ def get_n_similar(source_id,
                                       from_full=from_full,
                                       print_enabled=compute_print)
 
+        elif db.similars_dirty(source_id, fav_change):
+            # favorites changed since this was computed.
+            print('Cache stale (favorites changed more than {:.0%}). Fetching...'.format(
+                fav_change
+            ))
+            top_n = compute_similar(source_id,
+                                      from_full=from_full,
+                                      print_enabled=compute_print)
+
     print("analysis.py get_n_similar({}) returning:".format(source_id))
     print(top_n)
 
+    if top_n:
+        _similar_cache.pop(source_id, None)
+        if len(_similar_cache) >= constants.SIMILAR_CACHE_SIZE:
+            # evict the oldest
+            _similar_cache.pop(next(iter(_similar_cache)))
+        _similar_cache[source_id] = (time.time(), top_n)
+
     return top_n
 
-def compute_similar(source_id, from_full=False, print_enabled=False):
+def save_similars(db, source_id, top_n_ids, top_n_scores=None, pending=None):
+    '''
+    Writes a post's similars, or if pending is a list, appends them to it
+    for a later Database.write_similar_rows.
+    '''
+    row = (source_id, time.time(), top_n_ids, top_n_scores)
+    if pending is None:
+        db.write_similar_rows([row])
+    else:
+        pending.append(row)
+
+def compute_tag_similar(source_id, db, pending=None):
+    '''
+    computes top similar to the source by tags alone, saves it to the
+    database (see save_similars), and returns their ids as a list.
+    for posts without enough favorites.
+    '''
+    top_n_ids = tagsim.tag_similar(source_id, constants.SIM_PER_POST)
+    if not top_n_ids:
+        print("compute_tag_similar({}): no tags in common with anything!".format(source_id))
+        return None
+
+    top_n_ids = (top_n_ids + [0]*constants.SIM_PER_POST)[:constants.SIM_PER_POST]
+    save_similars(db, source_id, top_n_ids, pending=pending)
+    return top_n_ids
+
+def compute_similar(source_id, from_full=False, print_enabled=False,
+                    tag_weight=constants.TAG_SIM_WEIGHT, pending=None):
     '''
     computes top similar to the source, saves it to the database,
     and returns their ids as a list
+
+    if tag_weight, blends in that much tag similarity (see tagsim.blend).
+    posts with fewer than MIN_FAVS favorites use tag similarity alone.
+    if pending is a list, the similars are appended to it rather than
+    written (see save_similars).
     '''
 
     min_branch_favs = constants.BRANCH_FAVS_MIN
@@ -83,11 +180,14 @@ def compute_similar(source_id, from_full=False, print_enabled=False):
     db = Database()
 
     if not db.have_post_for_id(source_id):
-        db.get_post(source_id)
-        if not db.have_post_for_id(source_id):
+        if not db.get_post(source_id):
             print("compute_similar({}): don't have post for id after fetch!".format(source_id))
             return None
 
+    if db.get_favcount(source_id) < min_post_favs:
+        print('Fewer than {} favorites. Using tag similarity.'.format(min_post_favs))
+        return compute_tag_similar(source_id, db, pending)
+
     if not db.have_favs_for_id(source_id):
         # post not in database. let's fetch it and recalculate.
         print('Post favorites not in database, fetching...')
@@ -104,8 +204,8 @@ def compute_similar(source_id, from_full=False, print_enabled=False):
     branch_time = time.time() - branch_time
 
     if not results:
-        print("compute_similar({}): get_branch_favs returned nothing!".format(source_id))
-        return None
+        print("compute_similar({}): get_branch_favs returned nothing! Using tag similarity.".format(source_id))
+        return compute_tag_similar(source_id, db, pending)
 
     source_favs = max([r[1] for r in results])
 
@@ -123,7 +223,7 @@ def compute_similar(source_id, from_full=False, print_enabled=False):
     print(len(newresults),'/',len(results),'selected ({}%)'.format(
         len(newresults)/len(results)*100
     ))
-    results = sorted(newresults, key=itemgetter(1), reverse=True)
+    results = sorted(newresults, key=itemgetter(3), reverse=True)
     rq = len(results)
     slicept = min(int(rq*constants.BRANCH_FAVS_COEFF), constants.BRANCH_FAVS_MAX)
     results = results[:slicept]
@@ -138,13 +238,17 @@ def compute_similar(source_id, from_full=False, print_enabled=False):
 
     a = source_id
     sym_time = time.time()
+    # fetch everything missing up front rather than pair by pair
+    db.hydrate(bs)
     for b in bs:
         db.calc_and_put_sym_sim(a,b)
     sym_time = time.time() - sym_time
 
     print('Fetching {} similar...'.format(constants.SIM_PER_POST))
 
-    top_n = db.select_n_similar(source_id, constants.SIM_PER_POST)
+    # blending may promote candidates from further down
+    pool = constants.SIM_PER_POST * (4 if tag_weight else 1)
+    top_n = db.select_n_similar(source_id, pool)
 
     if print_enabled:
         linewidth = 99
@@ -157,6 +261,7 @@ def compute_similar(source_id, from_full=False, print_enabled=False):
                     ).format(*r)
                   )
     top_n_ids = []
+    top_n_scores = None
     print(branch_time,'s for branching,',sym_time,'s for',slicept,'posts')
     low_high = list(zip([p[0] for p in top_n],[p[1] for p in top_n]))
 
@@ -166,6 +271,10 @@ def compute_similar(source_id, from_full=False, print_enabled=False):
         else:
             top_n_ids.append(y)
 
+    if tag_weight:
+        top_n_ids = tagsim.blend(source_id, top_n, tag_weight)
+    else:
+        top_n_scores = db.score_sym_rows(top_n).tolist()
 
     for j, currentid in enumerate(top_n_ids):
         #find index
@@ -178,8 +287,10 @@ def compute_similar(source_id, from_full=False, print_enabled=False):
     if top_n_ids:
         # if there are not enough similar posts, fill with zeros
         top_n_ids = (top_n_ids + [0]*constants.SIM_PER_POST)[:constants.SIM_PER_POST]
+        if top_n_scores is not None:
+            top_n_scores = (top_n_scores + [0]*constants.SIM_PER_POST)[:constants.SIM_PER_POST]
 
-        db.write_similar_row(source_id, time.time(), top_n_ids)
+        save_similars(db, source_id, top_n_ids, top_n_scores, pending)
 
         print("compute_similar({}) returning:".format(source_id))
         print(top_n_ids)
@@ -190,6 +301,118 @@ def compute_similar(source_id, from_full=False, print_enabled=False):
         return None
 
 
+def compute_similar_multi(seed_ids, n=constants.SIMS_SHOWN, metric=None):
+    '''
+    Returns a list of the posts most similar to a set of seed posts.
+
+    Candidates come from one branch over the pooled users of all seeds and
+    are scored against every seed in one batch; a candidate's score is its
+    mean symmetric similarity (metric, SYM_SIM_MODE by default) to the seeds.
+    Results are not stored, as they have no single source.
+    '''
+    start = time.time()
+    db = Database()
+    seeds = list(dict.fromkeys(seed_ids))
+
+    db.hydrate(seeds)
+
+    results = db.get_branch_favs_multi(seeds)
+    results = [r for r in results
+               if r[0] not in seeds and r[1] >= constants.BRANCH_FAVS_MIN
+               and r[2] >= constants.MIN_FAVS]
+    if not results:
+        print("compute_similar_multi({}): no candidates!".format(seeds))
+        return []
+    rq = len(results)
+    results = results[:min(int(rq*constants.BRANCH_FAVS_COEFF), constants.BRANCH_FAVS_MAX)]
+    candidates = [r[0] for r in results]
+    print('{} seeds, {} candidates.'.format(len(seeds), len(candidates)))
+
+    overlaps = db.get_overlaps_multi(seeds, candidates)
+    favcounts = db.get_favcounts(seeds + candidates)
+
+    seed_index = {id: i for i, id in enumerate(seeds)}
+    cand_index = {id: i for i, id in enumerate(candidates)}
+    common = np.zeros((len(seeds), len(candidates)))
+    for a, b, overlap in overlaps:
+        common[seed_index[a], cand_index[b]] = overlap
+
+    seed_favs = np.array([favcounts.get(id) or 1 for id in seeds], dtype=float)[:, None]
+    cand_favs = np.array([favcounts.get(id) or 1 for id in candidates], dtype=float)[None, :]
+    metric = metric or constants.SYM_SIM_MODE
+    total = db.count_users() if metric in metrics.NEEDS_TOTAL else 1
+    scores = metrics.score(metric, common, seed_favs, cand_favs, total).mean(axis=0)
+
+    top = np.argsort(-scores)[:n]
+    print('compute_similar_multi took {:.3f}s'.format(time.time()-start))
+    return [candidates[i] for i in top]
+
+
+def recommend_for_user(username, n=constants.SIMS_SHOWN):
+    '''
+    Returns a list of posts recommended to a user from all of their favorites.
+
+    Each post similar to one of the user's favorites scores by its rank
+    among that favorite's similars, summed across favorites.
+    Only stored similars are used; favorites without any are skipped
+    rather than computed. Posts the user already favorited are excluded.
+    '''
+    start = time.time()
+    db = Database()
+    favs = db.get_user_favorites(username)
+    rows = db.select_similars_for_sources(favs)
+    print('{} favorites, {} with similars.'.format(
+        len(favs), len(set(r[0] for r in rows))))
+    if not rows:
+        return []
+
+    sim_posts = np.array([r[1] for r in rows])
+    ranks = np.array([r[2] for r in rows])
+    # first similar counts fully, last nearly nothing
+    weights = (constants.SIM_PER_POST + 1 - ranks) / constants.SIM_PER_POST
+
+    ids, inverse = np.unique(sim_posts, return_inverse=True)
+    scores = np.bincount(inverse, weights=weights)
+
+    keep = ~np.isin(ids, favs) & (ids != 0)
+    ids, scores = ids[keep], scores[keep]
+    top = np.argsort(-scores)[:n]
+
+    print('recommend_for_user({}) took {:.3f}s'.format(username, time.time()-start))
+    return ids[top].tolist()
+
+
+def warm_cache(limit=constants.WARM_POSTS, download=True):
+    '''
+    Preloads the most requested posts (see Database.log_access):
+    their similars and urls into this process's caches, and the
+    previews of their shown similars into the on-disk cache.
+    Only stored similars are loaded; nothing is computed.
+    '''
+    start = time.time()
+    db = Database()
+    popular = db.select_popular(limit)
+    print('Warming cache with {} posts...'.format(len(popular)))
+
+    warmed = 0
+    for source_id in popular:
+        packed = db.select_similars_packed(source_id)
+        if packed is None:
+            continue
+        top_n = packed[1][-constants.SIM_PER_POST:]
+        _similar_cache[source_id] = (time.time(), top_n)
+
+        shown = [id for id in top_n[:constants.SIMS_SHOWN] if id]
+        db.get_urls_for_ids([source_id] + shown)
+        if download:
+            for id in shown:
+                images.get_local(id)
+        warmed += 1
+
+    print('Warmed {}/{} posts in {}.'.format(
+        warmed, len(popular), seconds_to_dhms(time.time()-start)))
+
+
 def presample_randomly():
     db = Database()
 
@@ -214,6 +437,110 @@ def presample_randomly():
         ))
 
 
+def _parallel_worker(limiter, completed, max_depth):
+    '''
+    Worker process for presample_parallel.
+    Claims posts from the shared frontier until it is exhausted.
+    '''
+    Database.limiter = limiter
+    db = Database()
+
+    while True:
+        claimed = db.claim_frontier()
+        if not claimed:
+            if db.count_frontier_in_progress() == 0:
+                # nothing queued and nobody left to queue more
+                break
+            time.sleep(1)
+            continue
+
+        id, depth, priority = claimed
+        try:
+            branch_ids = get_n_similar(id)
+            if branch_ids and (max_depth is None or depth < max_depth):
+                db.push_frontier([b for b in branch_ids if b], depth + 1)
+        except Exception as e:
+            # one bad post shouldn't stop the worker, nor leave its claim
+            # in progress for the others to wait on forever
+            print('sampling {} failed: {!r}'.format(id, e))
+            db.rollback()
+        finally:
+            db.finish_frontier(id)
+
+        with completed.get_lock():
+            completed.value += 1
+
+
+def presample_parallel(root_id=None, workers=4, max_depth=None,
+                       report_interval=10):
+    '''
+    Computes similars using several worker processes.
+
+    Workers share a frontier stored in the database (presample_frontier)
+    and a single request budget, so together they never exceed the
+    configured rate limits and never compute the same post twice.
+
+    If root_id is given, traverses outward from it (breadth first, most
+    popular first), like presample_tree. Otherwise, as presample_randomly,
+    works through every post needing similars without traversing,
+    followed by every post whose similars are stale.
+    '''
+    db = Database()
+    db.init_db()
+    db.reset_frontier(clear=True)
+
+    if root_id:
+        db.push_frontier([root_id], 0)
+    else:
+        print('Searching for posts needing similars computed...')
+        need_update = db.find_similar_need_update()
+        random.shuffle(need_update)
+        need_update += db.find_dirty_similars()
+        db.push_frontier(need_update, 0)
+        max_depth = 0
+    # workers must not share this connection
+    del db
+
+    limiter = default_limiter() or RateLimiter(shared=True)
+    completed = multiprocessing.Value('i', 0)
+
+    procs = [multiprocessing.Process(target=_parallel_worker,
+                                     args=(limiter, completed, max_depth))
+             for i in range(workers)]
+    for p in procs:
+        p.start()
+
+    period = -1
+    last_count = 0
+    last_time = time.time()
+    while any(p.is_alive() for p in procs):
+        time.sleep(report_interval)
+
+        count = completed.value
+        now = time.time()
+        if count > last_count:
+            delta = (now - last_time) / (count - last_count)
+            if period == -1:
+                period = delta
+            else:
+                # ema 20
+                period = period * 0.95 + delta * 0.05
+            last_count, last_time = count, now
+
+        if period != -1:
+            print('{} workers: {} computed. {:5.2f} per minute.'.format(
+                workers, count, 60/period
+            ))
+
+    for p in procs:
+        p.join()
+    print('Parallel presampling done. {} computed.'.format(completed.value))
+
+    missing, skips, saved = Database().missing_stats()
+    print('{} posts known missing. {} fetches skipped, saving {}.'.format(
+        missing, skips, seconds_to_dhms(saved)))
+
+
 def presample_tree(root_id, download_target=True,
                    download_similar=constants.PRE_DOWNLOAD):
     db = Database()
@@ -564,12 +891,74 @@ def symmetric_benchmark():
                 times.append(dt)
         print('Post {} averages {:7.4f}s'.format(id,sum(times)/len(times)))
 
+def degree_benchmark(post_ids=None,
+                     settings=((0, 0), (5000, 0), (2000, 0), (1000, 0), (0, 0.5), (0, 1)),
+                     k=constants.SIM_PER_POST, mode='full'):
+    '''
+    Compares candidate generation under degree caps and damping
+    (see Database.get_branch_favs) against none at all.
+
+    settings are (degree_cap, damping) pairs, the first being the baseline.
+    For each, reports the time branching takes, the quantity of candidates,
+    and the overlap of the resulting top k (by exact SYM_SIM_MODE scores
+    over post_favorites) with the baseline's.
+    Posts default to the most requested (see Database.select_popular).
+    '''
+    db = Database()
+    db.refresh_user_degrees()
+    post_ids = post_ids or db.select_popular(20) or [constants.EXAMPLE_POST_ID]
+
+    def top_k(source_id, results):
+        results = [r for r in results
+                   if r[0] != source_id and r[1] >= constants.BRANCH_FAVS_MIN
+                   and r[2] >= constants.MIN_FAVS]
+        rq = len(results)
+        candidates = [r[0] for r in
+                      results[:min(int(rq*constants.BRANCH_FAVS_COEFF), constants.BRANCH_FAVS_MAX)]]
+        if not candidates:
+            return set()
+        overlaps = dict(((b, overlap) for a, b, overlap
+                         in db.get_overlaps_multi([source_id], candidates)))
+        favcounts = db.get_favcounts(candidates + [source_id])
+        common = np.array([overlaps.get(id, 0) for id in candidates])
+        cand_favs = np.array([favcounts.get(id) or 1 for id in candidates])
+        scores = metrics.score(constants.SYM_SIM_MODE, common,
+                               favcounts.get(source_id) or 1, cand_favs, db.count_users())
+        return set(candidates[i] for i in np.argsort(-scores)[:k])
+
+    totals = {s: [[], [], []] for s in settings}
+    for id in post_ids:
+        baseline = None
+        for cap, damping in settings:
+            start = time.time()
+            results = db.get_branch_favs(id, mode, cap, damping)
+            dt = time.time() - start
+            top = top_k(id, results)
+            if baseline is None:
+                baseline = top
+            overlap = len(top & baseline) / max(len(baseline), 1)
+            for total, value in zip(totals[(cap, damping)], (dt, len(results), overlap)):
+                total.append(value)
+
+    base_time = np.mean(totals[settings[0]][0])
+    base_candidates = np.mean(totals[settings[0]][1])
+    print('{} posts, top {} by {}.'.format(len(post_ids), k, constants.SYM_SIM_MODE))
+    for (cap, damping), (times, counts, overlaps) in totals.items():
+        print(('cap {:6d} damping {:4.2f}: {:8.4f}s ({:5.1f}%)  '
+               '{:9.1f} candidates ({:5.1f}%)  top-k overlap {:5.1f}%').format(
+            cap, damping, np.mean(times), np.mean(times) / max(base_time, 1e-9) * 100,
+            np.mean(counts), np.mean(counts) / max(base_candidates, 1) * 100,
+            np.mean(overlaps) * 100))
+
 if __name__ == '__main__':
     args = sys.argv[1:]
     if args:
         if args[0] == 'bench':
             symmetric_benchmark()
             post_id = 0
+        elif args[0] == 'degrees':
+            degree_benchmark([int(a) for a in args[1:]])
+            post_id = 0
         else:
             post_id = int(args[0])
     else:
@@ -8,20 +8,59 @@ DB_NAME = 'yre'
 DB_USER = 'yreuser'
 DB_PASSWORD = 'yiff' # keep this alphanumeric to avoid insertion issues
 DB_HOST = 'localhost'                                   #(owo)
+DB_POOL_SIZE = 32 # connections per process, when pooled (see database.use_pool)
+STREAM_ITERSIZE = 10000 # rows fetched at a time by large scans. see Database.stream.
+# a streaming replica for read-only queries, as a libpq DSN, e.g.
+# "dbname='yre' user='yreuser' password='yiff' host='localhost' port=5433"
+# None sends everything to the primary. see Database.read.
+DB_READ_DSN = None
+DB_REPLICA_MAX_LAG = 10 # seconds behind the primary before reads go to the primary
+DB_REPLICA_CHECK_INTERVAL = 5 # seconds between replication lag checks
 
 # rate limiting
 PAGE_DELAY = 2  # 30 per minute
 REQUEST_DELAY = 0.5  # 120 per minute
 FAV_REQ_TIMEOUT = 2  # seconds
+MISSING_RETRY_TIME = 86400  # seconds before checking a missing post again. doubles per check.
+MISSING_RETRY_MAX = 86400 * 90
+SHARED_RATE_LIMIT = True  # pace requests of all processes together. see ratelimit.
+CRAWL_RANGE_ATTEMPTS = 3  # tries at each id range of a parallel crawl
+
+# distributed computation. see distributed.py.
+WORK_UNIT_SIZE = 50 # posts per work unit
+WORK_HEARTBEAT = 30 # seconds between a worker's lease renewals
+WORK_LEASE_TIMEOUT = 300 # seconds without a heartbeat before a unit is reclaimed
+WORK_MAX_ATTEMPTS = 3 # claims before a unit is given up on
+WORK_POLL = 10 # seconds idle workers wait before looking for units again
 
 MIN_FAVS = 25
 SUBSET_FAVS_PER_POST = 256
+RESYNC_MIN_DRIFT = 5 # refetch favorites when fav_count moved by this many. see Database.resync_favs.
+FAVORITES_PARTITIONS = 16 # see Database.partition_favorites
+SAMPLE_SEED = 0 # favorites sampling seed. see Database.rekey_favorites after changing.
 BRANCH_FAVS_MIN = 5
 BRANCH_FAVS_COEFF = 1 # only this fraction of top posts by branch favs will be analysed
 BRANCH_FAVS_MAX = 1000 # ... or this number, whichever is lesser
-SYM_SIM_MODE = 'add_sim' # 'add_sim' or 'mult_sim'. see analysis.sym_sims for details.
+USER_DEGREE_CAP = 0 # if set, users with more favorites are left out of branching and favorites_subset
+USER_DEGREE_DAMPING = 0 # weight users by 1/favorites**this when ranking candidates. see Database.get_branch_favs.
+SYM_SIM_MODE = 'add_sim' # any of metrics.METRICS. see analysis.sym_sims for details.
+METRIC_SHRINKAGE = 10 # favorites added to the union by metrics.shrunk_jaccard
 SIM_PER_POST = 25 # store n similars per post
 SIMS_SHOWN = 10 # show n similars per post
+TAG_SIM_WEIGHT = 0 # 0-1. blend this much tag similarity into favorites similarity.
+TAG_MAX_DF = 0.25 # tags on more than this fraction of posts are ignored by tag similarity
+TAG_INDEX_FILE = None # path of a tagsim index written by 'tagsim.py write' to load, if any
+TOPK_FILE = None # path of a topk.write_topk_file snapshot to serve similars from, if any
 PRE_DOWNLOAD = False # download SIM_PER_POST posts during presampling
 
-DEFAULT_STALE_TIME = 10**7 # seconds
+# similars are recomputed when the post's fav_count moved by more than this
+# fraction, or its favorites were refetched, since they were computed.
+STALE_FAV_CHANGE = 0.1
+DEFAULT_STALE_TIME = None # seconds. if set, also recompute anything older.
+
+# in-process cache of similars, for the web app
+SIMILAR_CACHE_TTL = 600 # seconds
+SIMILAR_CACHE_SIZE = 10000 # posts
+WARM_POSTS = 500 # most requested posts to preload. see analysis.warm_cache.
+WARM_ON_STARTUP = False # preload before web workers take traffic
+PREVIEW_MAX_AGE = 86400 # seconds browsers may reuse a preview without asking
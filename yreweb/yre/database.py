@@ -1,12 +1,15 @@
-import requests
-from requests.packages.urllib3.util.retry import Retry
-from requests.adapters import HTTPAdapter
 import json
 import psycopg2
+import psycopg2.pool
 
 import json
 import time
 import random
+import queue
+import threading
+import itertools
+import multiprocessing
+import numpy as np
 from os.path import isfile, dirname, abspath
 import inspect
 
@@ -20,41 +23,192 @@ try:
 except ImportError:
     from utilities import *
 
+try:
+    from .ratelimit import RateLimiter
+    from . import ratelimit
+    from .remote import E621Api, make_session, PAGE_SIZE
+    from . import metrics
+except ImportError:
+    from ratelimit import RateLimiter
+    import ratelimit
+    from remote import E621Api, make_session, PAGE_SIZE
+    import metrics
+
+
+DSN = "dbname='{}' user='{}' password='{}' host='{}'".format(
+    constants.DB_NAME, constants.DB_USER, constants.DB_PASSWORD, constants.DB_HOST)
+
+# a streaming replica of the primary, for read-only queries. see Database.read.
+READ_DSN = constants.DB_READ_DSN
+
+_pool = None
+_read_pool = None
+
+def use_pool(maxconn=constants.DB_POOL_SIZE):
+    '''
+    Makes Database instances in this process share up to maxconn
+    connections, each returned to the pool when its instance is deleted.
+    Safe for many threads at once, as under ASGI. Instances made while
+    the pool is exhausted connect directly.
+    Replica connections, if READ_DSN is set, are pooled likewise.
+    '''
+    global _pool, _read_pool
+    _pool = psycopg2.pool.ThreadedConnectionPool(0, maxconn, DSN)
+    if READ_DSN:
+        _read_pool = psycopg2.pool.ThreadedConnectionPool(0, maxconn, READ_DSN)
+
 
 class Database():
     '''
     Database handles database access.
-    For now, it also performs remote access.
+    For now, it also performs remote access, through api (see remote).
 
     TODO:
     - better remote error handling
     - fix post sampling progress indication when using stop condition
     '''
-    def __init__(self):
-        self.conn = psycopg2.connect("dbname='{}' user='{}' password='{}' host='{}'".format(
-            constants.DB_NAME, constants.DB_USER, constants.DB_PASSWORD, constants.DB_HOST
-        ))
+    # shared rate limiter (see ratelimit). when set, every remote request
+    # waits on it; otherwise each Database paces itself. by default, the
+    # budget shared between all processes, if SHARED_RATE_LIMIT.
+    limiter = None
+
+    # remote.E621Api by default. set to a remote.LocalApi to work offline.
+    api = None
+
+    def __init__(self, dsn=None, read_dsn=None):
+        '''
+        dsn is the primary, which takes every write, and read_dsn an
+        optional replica of it for read-only queries (see read).
+        They default to DSN and READ_DSN, from constants.
+        '''
+        self.dsn = dsn or DSN
+        self.read_dsn = read_dsn if read_dsn is not None else READ_DSN
+
+        self.pooled = False
+        if _pool is not None and dsn is None:
+            try:
+                self.conn = _pool.getconn()
+                self.pooled = True
+            except psycopg2.pool.PoolError:
+                pass
+        if not self.pooled:
+            self.conn = psycopg2.connect(self.dsn)
 
         self.c = self.conn.cursor()
-        self.s = requests.session()
-        self.s.headers.update({'user-agent': constants.USER_AGENT})
 
-        retries = Retry(
-            total=10,
-            backoff_factor=1,
-            status_forcelist=[421, 500, 502, 520, 522, 524, 525]
-            )
-        self.s.mount('http://', HTTPAdapter(max_retries=retries))
-        self.s.mount('https://', HTTPAdapter(max_retries=retries))
+        # connected on first read
+        self.read_conn = None
+        self.read_pooled = False
+        self.pinned = False
+        self.s = make_session()
+
+        if Database.limiter is None:
+            Database.limiter = ratelimit.default_limiter()
+        if self.api is None:
+            self.api = E621Api(self.limiter, self.s)
 
         self.commit_on_del = True
 
     def __del__(self):
-        if self.commit_on_del:
+        failed = (self.conn.get_transaction_status() ==
+                  psycopg2.extensions.TRANSACTION_STATUS_INERROR)
+        if self.commit_on_del and not failed:
             self.conn.commit()
-        self.conn.close()
+        else:
+            self.rollback()
+        if self.pooled:
+            self.conn.rollback()
+            _pool.putconn(self.conn)
+        else:
+            self.conn.close()
+        self.close_replica()
         del self
 
+    # replication lag, per replica, as (time checked, seconds behind).
+    # shared by the instances of a process, so each checks rarely.
+    replica_lag = {}
+
+    def connect_replica(self):
+        if self.read_conn is None:
+            if _read_pool is not None and self.read_dsn == READ_DSN:
+                try:
+                    self.read_conn = _read_pool.getconn()
+                    self.read_pooled = True
+                except psycopg2.pool.PoolError:
+                    pass
+            if self.read_conn is None:
+                self.read_conn = psycopg2.connect(self.read_dsn)
+            # each read sees the latest replayed data, and holds nothing open
+            self.read_conn.autocommit = True
+        return self.read_conn.cursor()
+
+    def close_replica(self):
+        if self.read_conn is None:
+            return
+        if self.read_pooled:
+            _read_pool.putconn(self.read_conn, close=self.read_conn.closed != 0)
+        else:
+            self.read_conn.close()
+        self.read_conn = None
+        self.read_pooled = False
+
+    def get_replica_lag(self, rc):
+        '''
+        Returns how many seconds the replica is behind the primary,
+        checking at most every DB_REPLICA_CHECK_INTERVAL seconds.
+        The replica is behind if it has not replayed up to the primary's
+        current WAL position, by the age of the last transaction it did
+        replay. So a replica whose WAL receiver stopped falls behind as
+        soon as the primary writes, rather than looking fresh.
+        '''
+        checked, lag = self.replica_lag.get(self.read_dsn, (0, None))
+        if time.time() - checked > constants.DB_REPLICA_CHECK_INTERVAL:
+            self.c.execute('''select pg_current_wal_lsn()''')
+            primary_lsn = self.c.fetchall()[0][0]
+            rc.execute('''select case
+                          when not pg_is_in_recovery()
+                            or pg_last_wal_replay_lsn() >= %s::pg_lsn
+                          then 0
+                          else extract(epoch from now() - pg_last_xact_replay_timestamp())
+                          end''',
+                       (primary_lsn,))
+            lag = rc.fetchall()[0][0]
+            # nothing replayed at all
+            lag = float('inf') if lag is None else float(lag)
+            self.replica_lag[self.read_dsn] = (time.time(), lag)
+        return lag
+
+    def pin_primary(self):
+        '''
+        Sends this instance's later reads to the primary, so they see its
+        writes whatever the replica's lag. Called by every method that
+        writes data the reads may return.
+        '''
+        self.pinned = True
+
+    def read(self, query, params=None):
+        '''
+        Runs a read-only query and returns all of its rows.
+
+        Goes to the replica (read_dsn) when there is one, it lags by at
+        most DB_REPLICA_MAX_LAG seconds, and this instance has not written
+        anything it might read back (see pin_primary).
+        Otherwise, or if the replica fails, goes to the primary.
+        '''
+        if self.read_dsn and not self.pinned:
+            try:
+                rc = self.connect_replica()
+                if self.get_replica_lag(rc) <= constants.DB_REPLICA_MAX_LAG:
+                    rc.execute(query, params)
+                    return rc.fetchall()
+            except psycopg2.Error as e:
+                # e.g. down, or a query cancelled by replay
+                print('Replica read failed, using primary: {}'.format(e))
+                self.close_replica()
+                self.replica_lag[self.read_dsn] = (time.time(), float('inf'))
+        self.c.execute(query, params)
+        return self.c.fetchall()
+
     def init_db(self):
         self.c.execute('''CREATE TABLE IF NOT EXISTS posts
             (id integer primary key, status text, fav_count integer, score integer, rating text,
@@ -63,52 +217,324 @@ class Database():
             unique(id))''')
 
         self.c.execute('''CREATE TABLE IF NOT EXISTS post_tags
-            (post_id integer, tag_name text,
-             unique(post_id, tag_name))''')
+            (post_id integer, tag_id integer,
+             unique(post_id, tag_id))''')
 
         self.c.execute('''CREATE TABLE IF NOT EXISTS post_favorites
-            (post_id integer, favorited_user text,
+            (post_id integer, favorited_user text, sample_key integer,
              unique(post_id, favorited_user))''')
 
+        self.init_sample_keys()
+
+        # for per-user lookups such as recommend_for_user
+        self.c.execute('''CREATE INDEX IF NOT EXISTS post_favorites_user
+            on post_favorites(favorited_user)''')
+
         self.c.execute('''CREATE TABLE IF NOT EXISTS favorites_subset
-            (post_id integer, favorited_user text,
+            (post_id integer, favorited_user text, sample_key integer,
              unique(post_id, favorited_user))''')
+        self.c.execute('''ALTER TABLE favorites_subset
+            ADD COLUMN IF NOT EXISTS sample_key integer''')
 
+        # fav_count is the quantity of favorites fetched, for resync_favs
         self.c.execute('''CREATE TABLE IF NOT EXISTS favorites_meta
-            (post_id integer, updated bigint,
+            (post_id integer, updated bigint, fav_count integer,
              unique(post_id))''')
+        self.c.execute('''select 1 from information_schema.columns
+                          where table_name = 'favorites_meta' and column_name = 'fav_count'
+                       ''')
+        if not self.c.fetchall():
+            print('Counting fetched favorites...')
+            self.c.execute('''ALTER TABLE favorites_meta ADD COLUMN fav_count integer''')
+            self.c.execute('''update favorites_meta set fav_count =
+                              (select count(*) from post_favorites
+                               where post_favorites.post_id = favorites_meta.post_id)''')
 
         self.c.execute('''CREATE TABLE IF NOT EXISTS tags
-            (id integer primary key, name text,
-             count integer, type integer)''')
+            (id serial primary key, name text unique,
+             count integer default 0, type integer)''')
+        self.migrate_post_tags()
 
         self.c.execute('''CREATE TABLE IF NOT EXISTS post_similars
                        (source_id integer, updated bigint,
                        sim_post integer, sim_rank integer,
                        unique(source_id,sim_rank))''')
 
+        # post_similars, one row per post, for the hot read path
+        self.c.execute('''CREATE TABLE IF NOT EXISTS post_similars_packed
+                       (source_id integer primary key, updated bigint,
+                       sim_posts int4[], sim_scores float4[])''')
+
+        self.c.execute('''CREATE TABLE IF NOT EXISTS sym_similarity
+                       (low_id integer, high_id integer, common integer,
+                       add_sim real, mult_sim real,
+                       unique(low_id, high_id))''')
+        # favcounts the pair was scored with, so any metric (see metrics.py)
+        # can be computed from a row alone
+        self.c.execute('''select 1 from information_schema.columns
+                          where table_name = 'sym_similarity' and column_name = 'low_favs'
+                       ''')
+        if not self.c.fetchall():
+            print('Adding favcounts to sym_similarity...')
+            self.c.execute('''ALTER TABLE sym_similarity
+                              ADD COLUMN low_favs integer, ADD COLUMN high_favs integer''')
+            self.c.execute('''update sym_similarity as s set
+                              low_favs = a.fav_count, high_favs = b.fav_count
+                              from posts as a, posts as b
+                              where a.id = s.low_id and b.id = s.high_id''')
+        # when common was last counted exactly. see update_similarity_deltas.
+        self.c.execute('''ALTER TABLE sym_similarity
+                          ADD COLUMN IF NOT EXISTS computed bigint''')
+
+        # the data similars were computed from, for change-driven staleness
+        self.c.execute('''select to_regclass('similars_meta')''')
+        new_meta = self.c.fetchall()[0][0] is None
+        self.c.execute('''CREATE TABLE IF NOT EXISTS similars_meta
+                       (source_id integer primary key, computed bigint,
+                       fav_count integer, favs_updated bigint)''')
+        if new_meta:
+            # similars stored before similars_meta existed are taken as
+            # computed from the data as it is now, so only later changes
+            # make them dirty
+            self.c.execute('''insert into similars_meta
+                              select s.source_id, s.computed, posts.fav_count,
+                                     favorites_meta.updated
+                              from (select source_id, min(updated) as computed
+                                    from post_similars group by source_id) as s
+                              inner join posts on posts.id = s.source_id
+                              left join favorites_meta on favorites_meta.post_id = s.source_id
+                              ON CONFLICT (source_id) DO NOTHING''')
+
+        # favorites gained (delta 1) or lost (delta -1) when refreshing an
+        # already-fetched post. consumed by update_similarity_deltas.
+        self.c.execute('''CREATE TABLE IF NOT EXISTS favorites_delta
+                       (post_id integer, favorited_user text, recorded bigint,
+                       delta integer default 1)''')
+        self.c.execute('''ALTER TABLE favorites_delta
+                       ADD COLUMN IF NOT EXISTS delta integer default 1''')
+
+        # posts found not to exist, so they aren't fetched over and over.
+        # skips counts lookups answered from here instead of e621.
+        self.c.execute('''CREATE TABLE IF NOT EXISTS missing_posts
+                       (post_id integer primary key, first_seen bigint,
+                       last_checked bigint, checks integer, skips integer)''')
+
+        # leased batches of posts to compute similars for, shared by
+        # workers on any host. see distributed.py.
+        self.c.execute('''CREATE TABLE IF NOT EXISTS work_units
+                       (unit_id serial primary key, post_ids integer[],
+                       created bigint, claimed bigint, heartbeat bigint,
+                       worker text, attempts integer default 0, done bigint)''')
+        self.c.execute('''CREATE INDEX IF NOT EXISTS work_units_pending
+                       on work_units(unit_id) where done is null''')
+
+        # favorites per user, for degree caps. see refresh_user_degrees.
+        self.c.execute('''CREATE TABLE IF NOT EXISTS user_degrees
+                       (favorited_user text primary key, degree integer)''')
+
+        # which posts the web app is asked for, for cache warming
+        self.c.execute('''CREATE TABLE IF NOT EXISTS access_log
+                       (source_id integer primary key, hits integer,
+                       last_access bigint)''')
+
+        self.c.execute('''CREATE TABLE IF NOT EXISTS presample_frontier
+                       (post_id integer primary key, depth integer,
+                       priority integer, claimed bigint, done bigint)''')
+
         self.conn.commit()
         print("Database ready.")
 
-    def save_tags(self, post_id, tag_string):
+    def init_sample_keys(self):
+        '''
+        Sets up sample_key, which orders the favorites of each post
+        pseudorandomly but reproducibly (see SAMPLE_SEED).
+        Sampling K users of a post is then an index range scan
+        rather than a sort by random().
+        '''
+        self.c.execute('''
+            CREATE OR REPLACE FUNCTION yre_sample_key(integer, text, integer)
+            RETURNS integer AS
+            $$ select ('x' || substr(md5($3 || ':' || $1 || ':' || $2), 1, 8))::bit(32)::integer $$
+            LANGUAGE sql IMMUTABLE''')
+
+        self.c.execute('''select 1 from information_schema.columns
+                          where table_name = 'post_favorites' and column_name = 'sample_key'
+                       ''')
+        if not self.c.fetchall():
+            self.c.execute('''ALTER TABLE post_favorites ADD COLUMN sample_key integer''')
+            self.rekey_favorites(commit=False)
+
+        self.c.execute('''CREATE INDEX IF NOT EXISTS post_favorites_sample
+            on post_favorites(post_id, sample_key)''')
+
+    def rekey_favorites(self, seed=constants.SAMPLE_SEED, commit=True):
         '''
-        todo: search for tags in db that are not in current tags
+        Recomputes every sample_key with the given seed.
+        favorites_subset should be rebuilt afterwards.
         '''
-        print(post_id, tag_string)
-        tags = tag_string.split(' ')
+        print('Computing favorites sample keys (seed {})...'.format(seed))
+        self.c.execute('''update post_favorites
+                          set sample_key = yre_sample_key(post_id, favorited_user, %s)''',
+                       (seed,))
+        if commit:
+            self.conn.commit()
+
+    def throttle(self, delay):
+        '''
+        Waits until a remote request may be made, for requests
+        made outside of api.
+        '''
+        self.api.wait(delay)
 
-        for tag in tags:
-            self.c.execute('''INSERT INTO post_tags(post_id, tag_name) VALUES
-                              (%s, %s) ON CONFLICT DO NOTHING''',
-                              (post_id,
-                              tag))
+    def report(self, status_code):
+        '''
+        Tells the rate limiter how a request made outside of api went.
+        '''
+        self.api.report(status_code)
 
-    def save_post(self, post_dict, updated=None):
+    def migrate_post_tags(self):
+        '''
+        Converts a post_tags table of tag names into tag ids,
+        filling tags with every known tag and its count.
+        Does nothing if already converted.
+        '''
+        # tags may predate the default, leaving interned tags with no count
+        self.c.execute('''alter table tags alter column count set default 0''')
+
+        self.c.execute('''select 1 from information_schema.columns
+                          where table_name = 'post_tags' and column_name = 'tag_name'
+                       ''')
+        if not self.c.fetchall():
+            self.backfill_tag_counts()
+            return
+
+        print('Converting post_tags to tag ids. This will take several minutes.')
+        start = time.time()
+
+        # tags may predate its sequence and unique name
+        self.c.execute('''create sequence if not exists tags_id_seq owned by tags.id''')
+        self.c.execute('''select setval('tags_id_seq', coalesce(max(id), 0) + 1, false)
+                          from tags''')
+        self.c.execute('''alter table tags alter column id
+                          set default nextval('tags_id_seq')''')
+        self.c.execute('''create unique index if not exists tags_name on tags(name)''')
+
+        self.c.execute('''
+                       insert into tags(name, count)
+                       select tag_name, count(*) from post_tags group by tag_name
+                       ON CONFLICT (name) DO UPDATE SET count = EXCLUDED.count
+                       ''')
+        self.c.execute('''
+                       create table post_tags_ids as
+                       select post_id, tags.id as tag_id from post_tags
+                       inner join tags on tags.name = post_tags.tag_name
+                       ''')
+        self.c.execute('''drop table post_tags''')
+        self.c.execute('''alter table post_tags_ids rename to post_tags''')
+        self.c.execute('''alter table post_tags add unique(post_id, tag_id)''')
+        self.backfill_tag_counts()
+
+        self.conn.commit()
+        print('Converted post_tags in {}.'.format(seconds_to_dhms(time.time()-start)))
+
+    def backfill_tag_counts(self):
+        '''
+        Counts the posts of tags whose count was left null.
+        '''
+        self.c.execute('''update tags set count =
+                          (select count(*) from post_tags where tag_id = tags.id)
+                          where count is null''')
+        if self.c.rowcount:
+            print('Counted posts of {:,} tags.'.format(self.c.rowcount))
+
+    # tag ids never change, so they are remembered for the life of the process.
+    # ids interned in a transaction that is rolled back are forgotten (see rollback).
+    tag_ids = {}
+
+    def rollback(self):
+        '''
+        Rolls back the transaction, and forgets tag ids it may have created.
+        '''
+        self.conn.rollback()
+        Database.tag_ids.clear()
+
+    def intern_tags(self, names):
+        '''
+        Returns a dict of tag name to tag id, adding any unknown tags.
+        '''
+        unknown = list(set(n for n in names if n not in self.tag_ids))
+        if unknown:
+            self.c.execute('''
+                           insert into tags(name) select unnest(%s::text[])
+                           ON CONFLICT (name) DO NOTHING
+                           ''',
+                           (unknown,))
+            self.c.execute('''select name, id from tags where name = any(%s)''',
+                           (unknown,))
+            self.tag_ids.update(self.c.fetchall())
+        return {n: self.tag_ids[n] for n in names}
+
+    def save_tags_bulk(self, post_tag_strings):
+        '''
+        Sets the tags of several posts at once.
+        Takes a list of (post_id, tag_string) tuples.
+        Tags no longer on a post are removed, and tag counts follow both.
+        '''
+        self.pin_primary()
+        post_tags = [(post_id, list(dict.fromkeys(t for t in tag_string.split(' ') if t)))
+                     for post_id, tag_string in post_tag_strings]
+        ids = self.intern_tags([t for p, tags in post_tags for t in tags])
+
+        post_ids = [p for p, tags in post_tags]
+        pair_posts = [p for p, tags in post_tags for t in tags]
+        pair_tags = [ids[t] for p, tags in post_tags for t in tags]
+
+        self.c.execute('''
+                       with current as
+                           (select * from unnest(%s::integer[], %s::integer[])
+                            as t(post_id, tag_id)),
+                       removed as
+                           (delete from post_tags where post_id = any(%s)
+                            and (post_id, tag_id) not in (select * from current)
+                            returning tag_id)
+                       update tags set count = coalesce(tags.count, 0) - r.n
+                       from (select tag_id, count(*) as n from removed group by tag_id) as r
+                       where tags.id = r.tag_id
+                       ''',
+                       (pair_posts, pair_tags, post_ids))
+
+        self.c.execute('''
+                       with added as
+                           (insert into post_tags(post_id, tag_id)
+                            select * from unnest(%s::integer[], %s::integer[])
+                            ON CONFLICT DO NOTHING
+                            returning tag_id)
+                       update tags set count = coalesce(tags.count, 0) + a.n
+                       from (select tag_id, count(*) as n from added group by tag_id) as a
+                       where tags.id = a.tag_id
+                       ''',
+                       (pair_posts, pair_tags))
+
+    def save_tags(self, post_id, tag_string):
+        self.save_tags_bulk([(post_id, tag_string)])
+
+    def save_posts(self, post_dicts, updated=None):
+        '''
+        Saves a page of posts, interning all of their tags at once.
+        '''
+        self.pin_primary()
+        self.save_tags_bulk([(d['id'], d['tags']) for d in post_dicts])
+        for d in post_dicts:
+            self.save_post(d, updated, save_tags=False)
+
+    def save_post(self, post_dict, updated=None, save_tags=True):
+        self.pin_primary()
         if not updated:
             updated = time.time()
         d = post_dict  # for brevity
 
-        self.save_tags(d['id'], d['tags'])
+        if save_tags:
+            self.save_tags(d['id'], d['tags'])
 
         has_sample = 0
         if 'sample_url' in d and d['sample_url'] != d['file_url']:
@@ -142,16 +568,13 @@ class Database():
         count = 0
         while before_id != -1:
             start = time.time()
-            r = self.s.get('https://e621.net/post/index.json',
-                    params={'before_id': before_id, 'limit': '320'})
+            j = self.api.posts_page(before_id)
             request_elapsed = time.time() - start
-            j = json.loads(r.text)
 
             if len(j) > 0:
                 count += len(j)
                 t = time.time()
-                for p in j:
-                    self.save_post(p, updated=t)
+                self.save_posts(j, updated=t)
                 self.conn.commit()
                 save_elapsed = time.time() - t
                 before_id = min([p['id'] for p in j])
@@ -186,9 +609,111 @@ class Database():
                 before_id = - 1
                 break
 
-            while time.time() - start < constants.PAGE_DELAY:
-                # rate limit to 1 hz
-                time.sleep(0.001)
+    def _fetch_post_range(self, index, low_id, high_id, limiter, pages, failed):
+        '''
+        Fetcher stage of get_all_posts_parallel.
+        Walks one id range [low_id, high_id) from the top down, putting each
+        page on the pages queue as (index, posts), then (index, None) when done.
+        If a request fails, the part of the range not yet fetched is
+        appended to failed.
+        '''
+        # sessions aren't thread safe
+        api = E621Api(limiter) if isinstance(self.api, E621Api) else self.api
+        before_id = high_id
+        try:
+            while True:
+                j = api.posts_page(before_id)
+                if not j:
+                    break
+
+                # blocks while the writer is behind
+                pages.put((index, [p for p in j if p['id'] >= low_id]))
+
+                before_id = min([p['id'] for p in j])
+                if before_id <= low_id:
+                    break
+        except Exception as e:
+            print('Range {} [{}, {}) failed at {}: {}'.format(
+                index, low_id, high_id, before_id, e))
+            failed.append((low_id, before_id))
+        finally:
+            pages.put((index, None))
+
+    def get_all_posts_parallel(self, ranges=4, before_id=None, after_id=0,
+                               queue_size=8):
+        '''
+        As get_all_posts, but splits the ids between before_id and after_id
+        into ranges which are fetched concurrently, within the shared
+        page rate limit. Pages are written by this thread as they arrive,
+        so database writes overlap with the requests still in flight.
+        Ranges that fail are refetched from where they stopped,
+        up to CRAWL_RANGE_ATTEMPTS times.
+        '''
+        limiter = self.limiter or RateLimiter()
+
+        if before_id is None:
+            before_id = self.api.posts_page(limit=1)[0]['id'] + 1
+        print('Crawling ids {} to {} in {} ranges.'.format(
+            after_id, before_id, ranges))
+
+        step = -(-(before_id - after_id) // ranges)
+        bounds = [(after_id + i*step, min(after_id + (i+1)*step, before_id))
+                  for i in range(ranges)]
+
+        count = 0
+        for attempt in range(constants.CRAWL_RANGE_ATTEMPTS):
+            saved, bounds = self._crawl_ranges(bounds, limiter, queue_size)
+            count += saved
+            if not bounds:
+                break
+            print('{} ranges failed: {}'.format(len(bounds), bounds))
+        else:
+            raise RuntimeError('Crawl gave up on ranges {} after {} attempts.'.format(
+                bounds, constants.CRAWL_RANGE_ATTEMPTS))
+        print('Crawl done. {:,} posts saved.'.format(count))
+
+    def _crawl_ranges(self, bounds, limiter, queue_size):
+        '''
+        One pass of get_all_posts_parallel over the given id ranges.
+        Returns the quantity of posts saved, and the ranges left unfetched.
+        '''
+        pages = queue.Queue(maxsize=queue_size)
+        failed = []
+        fetchers = [threading.Thread(target=self._fetch_post_range,
+                                     args=(i, lo, hi, limiter, pages, failed),
+                                     daemon=True)
+                    for i, (lo, hi) in enumerate(bounds)]
+        for f in fetchers:
+            f.start()
+
+        count = 0
+        running = len(bounds)
+        while running:
+            index, j = pages.get()
+            if j is None:
+                running -= 1
+                # a failed fetcher records its range before finishing
+                if bounds[index][0] not in [lo for lo, hi in failed]:
+                    print('Range {} done.'.format(index))
+                continue
+
+            t = time.time()
+            self.save_posts(j, updated=t)
+            self.conn.commit()
+            save_elapsed = time.time() - t
+            count += len(j)
+
+            if j:
+                # print progress and statistics
+                lo, hi = bounds[index]
+                progress = (hi - min([p['id'] for p in j])) / (hi - lo)
+                print('range {} [{}-{}): {:05.2f}%  save: {:04.3f}s, {} queued, {:,} total'.format(
+                    index, str(lo).zfill(7), str(hi).zfill(7),
+                    progress*100, save_elapsed, pages.qsize(), count))
+
+        for f in fetchers:
+            f.join()
+        return count, failed
 
     def get_older_posts(self):
         # only useful for partial initial downloads
@@ -213,38 +738,90 @@ class Database():
         print('Found newest post:', after_id)
         self.get_all_posts(after_id=after_id - recent_count)
 
-    def get_post_ids(self):
-        self.c.execute(
-            '''select posts.id from posts''')
-        results = self.c.fetchall()
-        return [id[0] for id in results]
+    _streams = itertools.count()
+
+    def stream(self, query, params=None, itersize=constants.STREAM_ITERSIZE):
+        '''
+        Yields the rows of a query, fetching itersize at a time from a
+        server-side cursor, so memory use does not grow with the result.
+        The cursor is held across commits, so the connection may be used
+        (and committed) while iterating.
+        '''
+        c = self.conn.cursor(name='stream_{}'.format(next(self._streams)),
+                             withhold=True)
+        c.itersize = itersize
+        try:
+            c.execute(query, params)
+            yield from c
+        finally:
+            c.close()
+
+    def get_post_ids(self, itersize=constants.STREAM_ITERSIZE):
+        '''
+        Yields the id of every post.
+        '''
+        for r in self.stream('''select posts.id from posts''', itersize=itersize):
+            yield r[0]
+
+    def max_post_id(self, table='posts', column='id'):
+        self.c.execute('''select max({}) from {}'''.format(column, table))
+        return self.c.fetchall()[0][0]
 
     def save_favs(self, post_id, favorited_users):
+        # changes to the favorites of a post fetched before are recorded,
+        # so that update_similarity_deltas can patch existing similarities.
+        self.pin_primary()
+        refresh = bool(self.have_favs_for_id(post_id))
+        now = time.time()
+
         for u in favorited_users:
             self.c.execute(
                           '''INSERT INTO
-                             post_favorites(post_id, favorited_user)
-                             VALUES (%s,%s)
+                             post_favorites(post_id, favorited_user, sample_key)
+                             VALUES (%s,%s,yre_sample_key(%s,%s,%s))
                              ON CONFLICT DO NOTHING''',
-                          (post_id, u))
+                          (post_id, u, post_id, u, constants.SAMPLE_SEED))
+
+            if refresh and self.c.rowcount == 1:
+                self.c.execute(
+                              '''INSERT INTO
+                                 favorites_delta(post_id, favorited_user, recorded, delta)
+                                 VALUES (%s,%s,%s,1)''',
+                              (post_id, u, now))
 
+        if refresh and favorited_users:
+            # favorites since removed
             self.c.execute(
-                          '''INSERT INTO
-                             favorites_meta(post_id, updated)
-                             VALUES (%s,%s)
-                             ON CONFLICT DO NOTHING''',
-                          (post_id, time.time()))
+                          '''DELETE FROM post_favorites
+                             WHERE post_id = %s AND favorited_user <> all(%s)
+                             RETURNING favorited_user''',
+                          (post_id, list(favorited_users)))
+            removed = [r[0] for r in self.c.fetchall()]
+            if removed:
+                self.c.execute(
+                              '''DELETE FROM favorites_subset
+                                 WHERE post_id = %s AND favorited_user = any(%s)''',
+                              (post_id, removed))
+                self.c.executemany(
+                              '''INSERT INTO
+                                 favorites_delta(post_id, favorited_user, recorded, delta)
+                                 VALUES (%s,%s,%s,-1)''',
+                              [(post_id, u, now) for u in removed])
 
+        self.c.execute(
+                      '''INSERT INTO
+                         favorites_meta(post_id, updated, fav_count)
+                         VALUES (%s,%s,%s)
+                         ON CONFLICT (post_id) DO UPDATE SET
+                         updated = EXCLUDED.updated,
+                         fav_count = EXCLUDED.fav_count''',
+                      (post_id, now, len(favorited_users)))
 
     def get_favs(self, id):
-        r = self.s.get('https://e621.net/favorite/list_users.json',
-                       params={'id': id},
-                       timeout=constants.FAV_REQ_TIMEOUT)
-        j = json.loads(r.text)
-        if 'favorited_users' not in j:
+        favorited_users = self.api.favorite_users(id)
+        if favorited_users is None:
             print('No favs retrieved! Timed out%s')
             return
-        favorited_users = j['favorited_users'].split(',')
         if len(favorited_users) == 0:
             print('No favs retrieved! Timed out%s')
         self.save_favs(id, favorited_users)
@@ -252,7 +829,13 @@ class Database():
 
     def sample_favs(self, fav_limit = constants.MIN_FAVS):
         print('Reading known posts...')
-        self.c.execute(
+        self.c.execute('''select count(*) from posts where fav_count >= %s''',
+                       (fav_limit,))
+        q = self.c.fetchall()[0][0]
+        print('{:,} posts to get (fav limit {}). Optimal time {}.'.format(
+            q, fav_limit, seconds_to_dhms(q*constants.REQUEST_DELAY)))
+
+        remaining = self.stream(
             '''select
                 id, fav_count from posts
                where
@@ -260,25 +843,27 @@ class Database():
                order by
                 fav_count desc''',
                (fav_limit,))
-        remaining = self.c.fetchall()
 
+        self._get_favs_for_posts(remaining, total=q)
+        print('All favorites sampled.')
 
-
-
-        q = len(remaining)
-        print('{:,} posts to get (fav limit {}). Optimal time {}.'.format(
-            q, fav_limit, seconds_to_dhms(q*constants.REQUEST_DELAY)))
-
+    def _get_favs_for_posts(self, posts, label='favs.', total=None):
+        '''
+        Fetches favorites for each (id, quantity) in posts,
+        printing progress. quantity is only for display.
+        posts may be any iterable if total, their quantity, is given.
+        '''
+        q = len(posts) if total is None else total
         allstart = time.time()
         qty = 0
 
-        for r, favs in remaining:
+        for r, favs in posts:
             start = time.time()
             self.get_favs(r)
             qty += 1
             print('Got favs for', r, 'in',
                   round(time.time()-start, 2), 'seconds.',
-                  favs, 'favs.')
+                  favs, label)
             if qty % 20 == 0:
                 dt = time.time() - allstart
                 rate = dt/qty
@@ -288,114 +873,587 @@ class Database():
 
             self.conn.commit()
 
+    def resync_favs(self, min_drift=constants.RESYNC_MIN_DRIFT, limit=None):
+        '''
+        Refetches favorites only for posts whose fav_count (as of the last
+        post crawl) drifted from the quantity of favorites last fetched,
+        most drifted first. Gained and lost favorites are then applied to
+        existing similarities.
+        '''
+        print('Finding drifted favorites...')
+        self.c.execute(
+            '''select
+                posts.id, posts.fav_count - favorites_meta.fav_count as drift
+               from posts inner join favorites_meta on favorites_meta.post_id = posts.id
+               where
+                abs(posts.fav_count - favorites_meta.fav_count) >= %s
+               order by
+                abs(posts.fav_count - favorites_meta.fav_count) desc
+               limit %s''',
+               (min_drift, limit))
+        remaining = self.c.fetchall()
 
-            while time.time() - start < constants.REQUEST_DELAY:
-                time.sleep(0.001)
+        q = len(remaining)
+        print('{:,} posts drifted by at least {}. Optimal time {}.'.format(
+            q, min_drift, seconds_to_dhms(q*constants.REQUEST_DELAY)))
 
-        print('All favorites sampled.')
+        self._get_favs_for_posts(remaining, 'drift.')
+        print('All drifted favorites resynced.')
+        return self.update_similarity_deltas()
 
     def find_similar_need_update(self):
         '''
         Return ids for which favorites are known but similars are not.
         '''
-        remaining = [r[0] for r in self.c.execute(
+        self.c.execute(
             '''select distinct post_id from favorites_meta
                where post_id not in
-               (select distinct source_id from similars)''')]
+               (select distinct source_id from post_similars)''')
+        remaining = [r[0] for r in self.c.fetchall()]
         return remaining
 
-    def get_branch_favs(self, post_id, mode='partial'):
+    def push_frontier(self, post_ids, depth):
+        '''
+        Adds posts to the shared presampling frontier.
+        Posts already queued gain priority and keep their shallowest depth;
+        posts already done are left alone, so nothing is computed twice.
+        '''
+        self.c.executemany('''
+                           insert into presample_frontier
+                           values(%s,%s,1,null,null)
+                           ON CONFLICT (post_id) DO UPDATE SET
+                           depth = least(presample_frontier.depth, EXCLUDED.depth),
+                           priority = presample_frontier.priority + 1
+                           where presample_frontier.done is null
+                           ''',
+                           [(id, depth) for id in post_ids])
+        self.conn.commit()
+
+    def claim_frontier(self):
+        '''
+        Claims the shallowest, most popular unclaimed post of the frontier.
+        Returns (post_id, depth, priority), or None if nothing is claimable.
+        Concurrent claimers never receive the same post.
+        '''
+        self.c.execute('''
+                       update presample_frontier set claimed = %s
+                       where post_id =
+                       (select post_id from presample_frontier
+                        where claimed is null
+                        order by depth asc, priority desc
+                        limit 1 for update skip locked)
+                       returning post_id, depth, priority
+                       ''',
+                       (time.time(),))
+        claimed = self.c.fetchall()
+        self.conn.commit()
+        return claimed[0] if claimed else None
+
+    def finish_frontier(self, post_id):
+        self.c.execute('''update presample_frontier set done = %s
+                          where post_id = %s''',
+                       (time.time(), post_id))
+        self.conn.commit()
+
+    def count_frontier_in_progress(self):
+        '''
+        Returns the quantity of claimed posts which are not yet done.
+        '''
+        self.c.execute('''select count(*) from presample_frontier
+                          where claimed is not null and done is null''')
+        return self.c.fetchall()[0][0]
+
+    def reset_frontier(self, clear=False):
+        '''
+        Releases claims left behind by interrupted workers.
+        If clear, empties the frontier entirely.
+        '''
+        if clear:
+            self.c.execute('''delete from presample_frontier''')
+        else:
+            self.c.execute('''update presample_frontier set claimed = null
+                              where done is null''')
+        self.conn.commit()
+
+    def create_work_units(self, post_ids, unit_size=constants.WORK_UNIT_SIZE):
+        '''
+        Splits posts into work units of unit_size posts.
+        Posts already in an unfinished unit are left out.
+        Returns the quantity of units created.
+        '''
+        self.c.execute('''select distinct unnest(post_ids) from work_units
+                          where done is null''')
+        pending = set(r[0] for r in self.c.fetchall())
+        post_ids = [id for id in dict.fromkeys(post_ids) if id not in pending]
+
+        units = [post_ids[i:i+unit_size] for i in range(0, len(post_ids), unit_size)]
+        self.c.executemany('''insert into work_units(post_ids, created)
+                              values (%s, %s)''',
+                           [(unit, time.time()) for unit in units])
+        self.conn.commit()
+        return len(units)
+
+    def claim_work_unit(self, worker, timeout=constants.WORK_LEASE_TIMEOUT,
+                        max_attempts=constants.WORK_MAX_ATTEMPTS):
+        '''
+        Leases the oldest unfinished unit that is unclaimed, or whose worker
+        has not sent a heartbeat in timeout seconds.
+        Units claimed max_attempts times are given up on.
+        Returns (unit_id, post_ids), or None if nothing is claimable.
+        Concurrent claimers never receive the same unit.
+        '''
+        now = time.time()
+        self.c.execute('''
+                       update work_units set claimed = %s, heartbeat = %s,
+                       worker = %s, attempts = attempts + 1
+                       where unit_id =
+                       (select unit_id from work_units
+                        where done is null and attempts < %s
+                        and (claimed is null or heartbeat < %s)
+                        order by unit_id
+                        limit 1 for update skip locked)
+                       returning unit_id, post_ids
+                       ''',
+                       (now, now, worker, max_attempts, now - timeout))
+        claimed = self.c.fetchall()
+        self.conn.commit()
+        return claimed[0] if claimed else None
+
+    def heartbeat_work_unit(self, unit_id, worker):
+        '''
+        Renews a lease. Returns False if the unit was reclaimed by another worker.
+        '''
+        self.c.execute('''update work_units set heartbeat = %s
+                          where unit_id = %s and worker = %s and done is null''',
+                       (time.time(), unit_id, worker))
+        held = self.c.rowcount > 0
+        self.conn.commit()
+        return held
+
+    def finish_work_unit(self, unit_id, worker):
+        '''
+        Marks a unit done and commits, along with anything written
+        uncommitted before it (see write_similar_rows).
+        If the unit was reclaimed by another worker, rolls back instead
+        and returns False.
+        '''
+        self.c.execute('''update work_units set done = %s
+                          where unit_id = %s and worker = %s and done is null''',
+                       (time.time(), unit_id, worker))
+        if self.c.rowcount == 0:
+            self.rollback()
+            return False
+        self.conn.commit()
+        return True
+
+    def count_work_units(self, timeout=constants.WORK_LEASE_TIMEOUT,
+                         max_attempts=constants.WORK_MAX_ATTEMPTS):
+        '''
+        Returns the quantities of units (queued, leased, done, given up on).
+        Units with an expired lease count as queued.
+        '''
+        expired = time.time() - timeout
+        self.c.execute('''
+                       select
+                       count(*) filter (where done is null and attempts < %(max)s
+                           and (claimed is null or heartbeat < %(expired)s)),
+                       count(*) filter (where done is null and heartbeat >= %(expired)s),
+                       count(*) filter (where done is not null),
+                       count(*) filter (where done is null and attempts >= %(max)s
+                           and heartbeat < %(expired)s)
+                       from work_units
+                       ''',
+                       {'max': max_attempts, 'expired': expired})
+        return self.c.fetchall()[0]
+
+    def get_branch_favs(self, post_id, mode='partial',
+                        degree_cap=constants.USER_DEGREE_CAP,
+                        damping=constants.USER_DEGREE_DAMPING):
         '''
             returns list of tuples. each tuple contains:
-            (post_id, branch_favs, post_favs)
+            (post_id, branch_favs, post_favs, branch_weight)
+            by branch_weight, descending.
 
             mode is one of 'partial' or 'full'.
             'partial' uses favorites_subset while 'full' uses post_favorites.
+
+            users with more than degree_cap favorites (see user_degrees)
+            are not sampled, if degree_cap is set. each sampled user adds
+            1/degree**damping to the branch_weight of the posts they
+            favorited; without damping, branch_weight is branch_favs.
         '''
         source_db = 'post_favorites' if mode == 'full' else 'favorites_subset'
-        self.c.execute('''
-        select post_id, branch_favs, posts.fav_count from
-        (select post_id, count(post_id) as branch_favs from {} where favorited_user in
-            (select favorited_user from post_favorites as subtable where post_id = %s order by random() limit 256)
-            group by post_id order by count(post_id) desc)
+        rows = self.read('''
+        with sampled as
+            (select f.favorited_user,
+                    power(greatest(coalesce(d.degree, 1), 1), -%s) as weight
+             from post_favorites as f
+             left join user_degrees as d on d.favorited_user = f.favorited_user
+             where f.post_id = %s and (%s = 0 or coalesce(d.degree, 0) <= %s)
+             order by f.sample_key limit 256)
+        select post_id, branch_favs, posts.fav_count, branch_weight from
+        (select post_id, count(*) as branch_favs, {} as branch_weight
+            from {} as f inner join sampled as u on u.favorited_user = f.favorited_user
+            group by post_id)
         as toptable inner join posts on post_id = posts.id
-        '''.format(source_db),
-        (post_id,))
+        order by branch_weight desc
+        '''.format('sum(u.weight)' if damping else 'count(*)', source_db),
+        (damping, post_id, degree_cap, degree_cap))
 
-        return self.c.fetchall()
+        return rows
+
+    def get_branch_favs_multi(self, post_ids, mode='partial',
+                              users=constants.SUBSET_FAVS_PER_POST,
+                              degree_cap=constants.USER_DEGREE_CAP,
+                              damping=constants.USER_DEGREE_DAMPING):
+        '''
+        As get_branch_favs, for a set of posts at once.
+        Users are sampled from the favorites of all the posts together,
+        so the quantity sampled does not grow with the quantity of posts.
+        '''
+        source_db = 'post_favorites' if mode == 'full' else 'favorites_subset'
+        rows = self.read('''
+        with sampled as
+            (select f.favorited_user,
+                    power(greatest(min(coalesce(d.degree, 1)), 1), -%s) as weight
+             from post_favorites as f
+             left join user_degrees as d on d.favorited_user = f.favorited_user
+             where f.post_id = any(%s) and (%s = 0 or coalesce(d.degree, 0) <= %s)
+             group by f.favorited_user order by min(f.sample_key) limit %s)
+        select post_id, branch_favs, posts.fav_count, branch_weight from
+        (select post_id, count(*) as branch_favs, {} as branch_weight
+            from {} as f inner join sampled as u on u.favorited_user = f.favorited_user
+            group by post_id)
+        as toptable inner join posts on post_id = posts.id
+        order by branch_weight desc
+        '''.format('sum(u.weight)' if damping else 'count(*)', source_db),
+        (damping, list(post_ids), degree_cap, degree_cap, users))
+
+        return rows
 
-    def write_similar_row(self, source_id, update_time, similar_list):
-            insert_list = []
+    def refresh_user_degrees(self):
+        '''
+        Recounts the favorites of every user into user_degrees,
+        for degree caps and damping in get_branch_favs.
+        '''
+        self.pin_primary()
+        start = time.time()
+        self.c.execute('''delete from user_degrees''')
+        self.c.execute('''insert into user_degrees
+                          select favorited_user, count(*) from post_favorites
+                          group by favorited_user''')
+        count = self.c.rowcount
+        self.conn.commit()
+        print('Counted favorites of {:,} users in {}.'.format(
+            count, seconds_to_dhms(time.time()-start)))
+
+    def get_overlaps_multi(self, a_ids, b_ids):
+        '''
+        Returns (a, b, overlap) for every pair of a post from a_ids and a post
+        from b_ids favorited by at least one common user, in one query.
+        '''
+        return self.read(
+            '''
+            select a.post_id, b.post_id, count(*) from post_favorites as a
+            inner join post_favorites as b on b.favorited_user = a.favorited_user
+            where a.post_id = any(%s) and b.post_id = any(%s)
+            group by a.post_id, b.post_id
+            ''',
+            (list(a_ids), list(b_ids)))
+
+    def get_favcounts(self, post_ids):
+        '''
+        returns a dict of post id to fav_count.
+        '''
+        rows = self.read('''select id, fav_count from posts where id = any(%s)''',
+                       (list(post_ids),))
+        return dict(rows)
+
+    def write_similar_row(self, source_id, update_time, similar_list, scores=None):
+        self.write_similar_rows([(source_id, update_time, similar_list, scores)])
+
+    def write_similar_rows(self, rows, commit=True):
+        '''
+        Writes the similars of many posts at once.
+        rows are (source_id, update_time, similar_list, scores) tuples,
+        scores being optional (None). A later row for the same source
+        replaces an earlier one.
+        '''
+        rows = list({r[0]: r for r in rows}.values())
+        if not rows:
+            return
+        self.pin_primary()
+
+        sources, updates, sim_posts, sim_ranks = [], [], [], []
+        for source_id, update_time, similar_list, scores in rows:
             for i, s in enumerate(similar_list):
-                r = i + 1
-                insert_list.append((source_id, update_time, s, r))
-
-            self.c.executemany('''
-                           insert into post_similars
-                           values(%s,%s,%s,%s)
-                           ON CONFLICT (source_id, sim_rank) DO UPDATE SET
-                           updated = EXCLUDED.updated,
-                           sim_post = EXCLUDED.sim_post
-                           ''',
-                           insert_list)
+                sources.append(source_id)
+                updates.append(update_time)
+                sim_posts.append(s)
+                sim_ranks.append(i + 1)
+
+        self.c.execute('''
+                       insert into post_similars
+                       select * from unnest(%s::integer[], %s::bigint[],
+                                            %s::integer[], %s::integer[])
+                       ON CONFLICT (source_id, sim_rank) DO UPDATE SET
+                       updated = EXCLUDED.updated,
+                       sim_post = EXCLUDED.sim_post
+                       ''',
+                       (sources, [int(u) for u in updates], sim_posts, sim_ranks))
+
+        self.c.executemany('''
+                       insert into post_similars_packed
+                       values(%s,%s,%s,%s)
+                       ON CONFLICT (source_id) DO UPDATE SET
+                       updated = EXCLUDED.updated,
+                       sim_posts = EXCLUDED.sim_posts,
+                       sim_scores = EXCLUDED.sim_scores
+                       ''',
+                       [(source_id, update_time, list(similar_list), scores)
+                        for source_id, update_time, similar_list, scores in rows])
+
+        self.c.execute('''
+                       insert into similars_meta
+                       select posts.id, t.computed, posts.fav_count, favorites_meta.updated
+                       from unnest(%s::integer[], %s::bigint[]) as t(source_id, computed)
+                       inner join posts on posts.id = t.source_id
+                       left join favorites_meta on favorites_meta.post_id = posts.id
+                       ON CONFLICT (source_id) DO UPDATE SET
+                       computed = EXCLUDED.computed,
+                       fav_count = EXCLUDED.fav_count,
+                       favs_updated = EXCLUDED.favs_updated
+                       ''',
+                       ([r[0] for r in rows], [int(r[1]) for r in rows]))
 
+        if commit:
             self.conn.commit()
 
+    # posts whose data changed since their similars were computed.
+    # fav_count is compared relative to its recorded value.
+    # sources selects the posts to check, as source_id.
+    DIRTY_SIMILARS_QUERY = '''
+        select post_similars_ids.source_id from
+        ({sources}) as post_similars_ids
+        left join similars_meta on similars_meta.source_id = post_similars_ids.source_id
+        left join posts on posts.id = post_similars_ids.source_id
+        left join favorites_meta on favorites_meta.post_id = post_similars_ids.source_id
+        where (similars_meta.source_id is null
+        or abs(posts.fav_count - similars_meta.fav_count) >
+            %(threshold)s * greatest(similars_meta.fav_count, 1)
+        or favorites_meta.updated > similars_meta.favs_updated)
+        '''
+
+    def similars_dirty(self, source_id, threshold=constants.STALE_FAV_CHANGE):
+        '''
+        returns boolean reflecting whether the post's favorites changed
+        enough since its similars were computed to warrant recomputing them.
+        '''
+        self.c.execute(self.DIRTY_SIMILARS_QUERY.format(
+                           sources='select %(source_id)s as source_id'),
+                       {'threshold': threshold, 'source_id': source_id})
+        return bool(self.c.fetchall())
+
+    def find_dirty_similars(self, threshold=constants.STALE_FAV_CHANGE):
+        '''
+        Return ids whose similars are known but stale, most favorited first.
+        '''
+        self.c.execute(self.DIRTY_SIMILARS_QUERY.format(
+                           sources='select distinct source_id from post_similars') +
+                       'order by posts.fav_count desc nulls last',
+                       {'threshold': threshold})
+        return [r[0] for r in self.c.fetchall()]
+
+    # sample urls never change, so they are remembered for the life of the process
+    url_cache = {}
+
     def get_urls_for_ids(self, id_list):
         urls = []
         for id in id_list:
-            self.c.execute('''
+            if id in self.url_cache:
+                urls.append(self.url_cache[id])
+                continue
+
+            fetched = self.read('''
                            select sample_url from posts where id = %s
                            ''',
                            (id,))
-            fetched = self.c.fetchall()
             if fetched:
                 urls.append(fetched[0][0])
+                self.url_cache[id] = fetched[0][0]
             else:
                 urls.append('')
                 print('No URL for {}!'.format(id))
 
         return urls
 
+    def log_access(self, source_id):
+        self.pin_primary()
+        self.c.execute('''
+                       insert into access_log values (%s, 1, %s)
+                       ON CONFLICT (source_id) DO UPDATE SET
+                       hits = access_log.hits + 1,
+                       last_access = EXCLUDED.last_access
+                       ''',
+                       (source_id, time.time()))
+        self.conn.commit()
+
+    def select_popular(self, limit=constants.WARM_POSTS, since=None):
+        '''
+        returns ids of the most requested posts,
+        optionally only those requested since the given time.
+        '''
+        rows = self.read('''select source_id from access_log
+                          where last_access >= %s
+                          order by hits desc limit %s''',
+                       (since or 0, limit))
+        return [r[0] for r in rows]
+
     def select_similar(self, source_id):
         self.c.execute('''select * from similars where source_id = %s''',
                      (source_id,))
         return self.c.fetchall()
 
     def select_similars(self, source_id):
-        self.c.execute('''select * from post_similars where source_id = %s
+        return self.read('''select * from post_similars where source_id = %s
                           order by sim_rank asc''',
                      (source_id,))
-        return self.c.fetchall()
 
-    def select_n_similar(self, source_id, limit=10):
+    def select_similars_packed(self, source_id):
+        '''
+        returns (updated, [sim_post, ...]) in rank order, or None.
+        '''
+        fetched = self.read('''select updated, sim_posts from post_similars_packed
+                          where source_id = %s''',
+                     (source_id,))
+        return fetched[0] if fetched else None
 
-        mode = constants.SYM_SIM_MODE
-        self.c.execute('''select * from sym_similarity where low_id = %s or high_id = %s
-                       order by {} desc limit %s'''.format(mode),
-                     (source_id, source_id, limit))
-        return self.c.fetchall()
+    def pack_similars(self):
+        '''
+        Fills post_similars_packed from post_similars,
+        for similars written before it existed.
+        '''
+        self.pin_primary()
+        start = time.time()
+        self.c.execute('''
+                       insert into post_similars_packed
+                       select source_id, min(updated),
+                       array_agg(sim_post order by sim_rank), null
+                       from post_similars group by source_id
+                       ON CONFLICT (source_id) DO NOTHING
+                       ''')
+        count = self.c.rowcount
+        self.conn.commit()
+        print('Packed similars of {:,} posts in {}.'.format(
+            count, seconds_to_dhms(time.time()-start)))
+
+    SYM_SIM_COLUMNS = '''low_id, high_id, common, add_sim, mult_sim,
+                         low_favs, high_favs'''
 
-    def update_favorites_subset(self, limit=constants.SUBSET_FAVS_PER_POST, fav_min=constants.MIN_FAVS, fav_max=9999):
+    def select_n_similar(self, source_id, limit=10, metric=None):
+        '''
+        Returns the limit sym_similarity rows involving the source that are
+        most similar by metric (SYM_SIM_MODE by default), best first.
+        Stored metrics are ordered by the database; any other in
+        metrics.METRICS is scored here from all of the source's rows.
+        '''
+        metric = metric or constants.SYM_SIM_MODE
+        if metric in ('add_sim', 'mult_sim'):
+            return self.read('''select {} from sym_similarity
+                           where low_id = %s or high_id = %s
+                           order by {} desc limit %s'''.format(self.SYM_SIM_COLUMNS, metric),
+                         (source_id, source_id, limit))
+
+        rows = self.read('''select {} from sym_similarity
+                       where low_id = %s or high_id = %s'''.format(self.SYM_SIM_COLUMNS),
+                     (source_id, source_id))
+        scores = self.score_sym_rows(rows, metric)
+        return [rows[i] for i in np.argsort(-scores, kind='stable')[:limit]]
+
+    def score_sym_rows(self, rows, metric=None):
+        '''
+        Returns the scores of select_n_similar rows by metric
+        (SYM_SIM_MODE by default), as an array.
+        '''
+        metric = metric or constants.SYM_SIM_MODE
+        total = self.count_users() if metric in metrics.NEEDS_TOTAL else 1
+        return metrics.score_rows(metric, rows, total)
+
+    _total_users = None
+
+    def count_users(self):
+        '''
+        Returns the quantity of users with favorites, from stats_user_degree
+        if it has been refreshed (see refresh_stats). Counted once per process.
+        '''
+        if Database._total_users is None:
+            self.c.execute('''select 1 from pg_matviews
+                              where matviewname = 'stats_user_degree' and ispopulated''')
+            if self.c.fetchall():
+                self.c.execute('''select sum(users) from stats_user_degree''')
+            else:
+                self.c.execute('''select count(distinct favorited_user) from post_favorites''')
+            Database._total_users = int(self.c.fetchall()[0][0] or 0) or 1
+        return Database._total_users
+
+    def select_similars_for_sources(self, source_ids):
+        '''
+        returns (source_id, sim_post, sim_rank) for every stored similar
+        of every given source, in one query.
+        '''
+        return self.read('''select source_id, sim_post, sim_rank from post_similars
+                          where source_id = any(%s)''',
+                       (list(source_ids),))
+
+    def get_user_favorites(self, username):
+        '''
+        returns ids of the posts favorited by the user.
+        '''
+        rows = self.read('''select post_id from post_favorites
+                          where favorited_user = %s''',
+                       (username,))
+        return [r[0] for r in rows]
+
+    def update_favorites_subset(self, limit=constants.SUBSET_FAVS_PER_POST, fav_min=constants.MIN_FAVS, fav_max=9999,
+                                partition=None, degree_cap=constants.USER_DEGREE_CAP):
         '''
         Loads only posts over favorite threshhold into table favorites_subset.
         Additionally limits number of favorites per post.
         Dramatically reduces compute time.
+
+        If degree_cap is set, users with more favorites than it
+        (see user_degrees) are left out.
+
+        If partition names a partition of post_favorites (see
+        favorites_partitions), only the posts in it are rebuilt,
+        so partitions may be rebuilt in parallel.
         '''
+        self.pin_primary()
         print('Updating favorites subset. This will take several minutes.')
         start = time.time()
+        source_db = partition or 'post_favorites'
 
         print('Deleting old...')
-        self.c.execute('''delete from favorites_subset''')
+        if partition:
+            self.c.execute('''delete from favorites_subset where post_id in
+                              (select post_id from {})'''.format(partition))
+        else:
+            self.c.execute('''delete from favorites_subset''')
 
         print('Selecting and writing new subset, fav range {}-{}, limit {:,}...'.format(
             fav_min, fav_max, limit))
 
-        post_ids = self.get_post_ids()
-
-        q = max(post_ids)
+        if partition:
+            post_ids = (r[0] for r in self.stream(
+                '''select distinct post_id from {}'''.format(partition)))
+            q = self.max_post_id(partition, 'post_id') or 1
+        else:
+            post_ids = self.get_post_ids()
+            q = self.max_post_id() or 1
 
+        n = 0
         for id in post_ids:
+            n += 1
             # print progress
             if id % 10000 == 0:
                 print('{}/{}: {:5.2f}%'.format(
@@ -404,59 +1462,340 @@ class Database():
 
             self.c.execute('''
                            insert into favorites_subset
-                           select post_id, favorited_user from post_favorites
+                           select post_id, f.favorited_user, sample_key from {} as f
                                 inner join posts on post_id = posts.id
+                                left join user_degrees as d
+                                on d.favorited_user = f.favorited_user
                                 where post_id = %s and
-                                posts.fav_count >= %s and posts.fav_count <= %s
-                                order by random()
-                                limit %s''',
-                                (id, fav_min, fav_max, limit))
+                                posts.fav_count >= %s and posts.fav_count <= %s and
+                                (%s = 0 or coalesce(d.degree, 0) <= %s)
+                                order by sample_key
+                                limit %s'''.format(source_db),
+                                (id, fav_min, fav_max, degree_cap, degree_cap, limit))
 
         print('Committing changes.')
         self.conn.commit()
-        status = 'Done with subset. Fav min {}, limit {:,}. Took {} ({:.4f}ms per post.)'.format(
+        status = 'Done with subset{}. Fav min {}, limit {:,}. Took {} ({:.4f}ms per post.)'.format(
+            ' ' + partition if partition else '',
             fav_min, limit, seconds_to_dhms(time.time()-start),
-            (time.time()-start)*1000/q)
+            (time.time()-start)*1000/max(n, 1))
         print(status)
         #print('Vacuuming...')
         #self.c.execute('''vacuum''')
         return status
 
+    def favorites_partitions(self):
+        '''
+        Returns the names of the partitions of post_favorites,
+        or just post_favorites if it isn't partitioned.
+        '''
+        self.c.execute('''
+                       select child.relname from pg_inherits
+                       inner join pg_class as child on child.oid = inhrelid
+                       inner join pg_class as parent on parent.oid = inhparent
+                       where parent.relname = 'post_favorites'
+                       order by child.relname
+                       ''')
+        return [r[0] for r in self.c.fetchall()] or ['post_favorites']
+
+    def partition_favorites(self, partitions=constants.FAVORITES_PARTITIONS,
+                            batch_posts=10000):
+        '''
+        Moves post_favorites into a table hash partitioned by post_id.
+
+        Writes to post_favorites keep working throughout: a trigger mirrors
+        them into the new table while existing rows are copied over in
+        batches, each its own transaction. The tables are then swapped in
+        one short transaction. The old table is kept as post_favorites_old.
+        stats_user_degree, which reads post_favorites, is rebuilt on the new
+        table (see refresh_stats).
+        '''
+        if self.favorites_partitions() != ['post_favorites']:
+            print('post_favorites is already partitioned.')
+            return
+        print('Partitioning post_favorites into {} partitions.'.format(partitions))
+        start = time.time()
+
+        self.c.execute('''CREATE TABLE post_favorites_new
+            (post_id integer, favorited_user text, sample_key integer,
+             unique(post_id, favorited_user))
+            PARTITION BY HASH (post_id)''')
+        for i in range(partitions):
+            self.c.execute('''CREATE TABLE post_favorites_p{} PARTITION OF
+                              post_favorites_new
+                              FOR VALUES WITH (MODULUS %s, REMAINDER %s)'''.format(i),
+                           (partitions, i))
+        self.c.execute('''CREATE INDEX post_favorites_new_user
+            on post_favorites_new(favorited_user)''')
+        self.c.execute('''CREATE INDEX post_favorites_new_sample
+            on post_favorites_new(post_id, sample_key)''')
+
+        self.c.execute('''
+            CREATE OR REPLACE FUNCTION yre_mirror_favorites() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP = 'DELETE' THEN
+                    DELETE FROM post_favorites_new WHERE post_id = OLD.post_id
+                        AND favorited_user = OLD.favorited_user;
+                    RETURN OLD;
+                END IF;
+                INSERT INTO post_favorites_new VALUES
+                    (NEW.post_id, NEW.favorited_user, NEW.sample_key)
+                    ON CONFLICT (post_id, favorited_user) DO UPDATE SET
+                    sample_key = EXCLUDED.sample_key;
+                RETURN NEW;
+            END $$ LANGUAGE plpgsql''')
+        self.c.execute('''CREATE TRIGGER post_favorites_mirror
+            AFTER INSERT OR UPDATE OR DELETE ON post_favorites
+            FOR EACH ROW EXECUTE PROCEDURE yre_mirror_favorites()''')
+        self.conn.commit()
+
+        self.c.execute('''select max(post_id) from post_favorites''')
+        q = self.c.fetchall()[0][0] or 0
+        for low in range(0, q + 1, batch_posts):
+            self.c.execute('''
+                           insert into post_favorites_new
+                           select post_id, favorited_user, sample_key from post_favorites
+                           where post_id >= %s and post_id < %s
+                           ON CONFLICT DO NOTHING
+                           ''',
+                           (low, low + batch_posts))
+            self.conn.commit()
+            print('{}/{}: {:5.2f}%'.format(low, q, low/max(q, 1) * 100))
+
+        print('Swapping tables...')
+        self.c.execute('''LOCK TABLE post_favorites IN EXCLUSIVE MODE''')
+        self.c.execute('''DROP TRIGGER post_favorites_mirror ON post_favorites''')
+        # a batch may copy a row deleted after its snapshot was taken, which
+        # the trigger had nothing to delete for yet
+        self.c.execute('''delete from post_favorites_new as n
+                          where not exists
+                          (select 1 from post_favorites as f
+                           where f.post_id = n.post_id
+                           and f.favorited_user = n.favorited_user)''')
+        print('Removed {} favorites deleted while copying.'.format(self.c.rowcount))
+        # views follow the table, not its name, so would keep reading the old one
+        self.c.execute('''DROP MATERIALIZED VIEW IF EXISTS stats_user_degree''')
+        self.c.execute('''ALTER TABLE post_favorites RENAME TO post_favorites_old''')
+        for index in ['user', 'sample']:
+            self.c.execute('''ALTER INDEX IF EXISTS post_favorites_{0}
+                              RENAME TO post_favorites_old_{0}'''.format(index))
+            self.c.execute('''ALTER INDEX post_favorites_new_{0}
+                              RENAME TO post_favorites_{0}'''.format(index))
+        self.c.execute('''ALTER TABLE post_favorites_new RENAME TO post_favorites''')
+        self.conn.commit()
+        Database._total_users = None
+        self.refresh_stats()
+
+        print('Partitioned post_favorites in {}. post_favorites_old may be dropped.'.format(
+            seconds_to_dhms(time.time()-start)))
+
+    def vacuum_favorites(self):
+        '''
+        Vacuums post_favorites one partition at a time.
+        '''
+        self.conn.commit()
+        self.conn.autocommit = True
+        try:
+            for partition in self.favorites_partitions():
+                start = time.time()
+                self.c.execute('''VACUUM ANALYZE {}'''.format(partition))
+                print('Vacuumed {} in {}.'.format(
+                    partition, seconds_to_dhms(time.time()-start)))
+        finally:
+            self.conn.autocommit = False
+
+    def rerank_similars(self, source_id):
+        '''
+        Rewrites the stored similars of a post from its current
+        sym_similarity rows, without computing any new pairs.
+        '''
+        self.pin_primary()
+        top_n = self.select_n_similar(source_id, constants.SIM_PER_POST)
+        top_n_ids = [r[1] if r[0] == source_id else r[0] for r in top_n]
+        if top_n_ids:
+            top_n_ids = (top_n_ids + [0]*constants.SIM_PER_POST)[:constants.SIM_PER_POST]
+            self.write_similar_row(source_id, time.time(), top_n_ids)
+
+    def update_similarity_deltas(self):
+        '''
+        Applies favorites recorded in favorites_delta to sym_similarity.
+        Only pairs sharing a user with a gained or lost favorite are touched,
+        and only posts with a touched pair have their similars re-ranked, so
+        the cost follows the quantity of changes rather than the whole dataset.
+        '''
+        self.pin_primary()
+        start = time.time()
+        cutoff = start
+
+        # a pair changes by the quantity of users who favorited both
+        # afterwards but not before (added joined with current favorites),
+        # less those who did before but not afterwards (removed joined
+        # with favorites as they were). a user changing both posts of a
+        # pair appears twice in a join, hence counting distinct users.
+        # pairs computed after a delta was recorded already counted it
+        # (see calc_and_put_sym_sim), so it is not applied to them.
+        self.c.execute('''
+            with delta as
+                (select post_id, favorited_user, delta, max(recorded) as recorded
+                 from favorites_delta
+                 where recorded <= %s
+                 group by post_id, favorited_user, delta),
+            added as
+                (select post_id, favorited_user, recorded from delta where delta > 0),
+            removed as
+                (select post_id, favorited_user, recorded from delta where delta < 0),
+            previous as
+                (select f.post_id, f.favorited_user from post_favorites as f
+                 where f.favorited_user in (select favorited_user from removed)
+                 and (f.post_id, f.favorited_user) not in
+                     (select post_id, favorited_user from added)
+                 union
+                 select post_id, favorited_user from removed),
+            changes as
+                (select s.low_id, s.high_id, count(distinct d.favorited_user) as n
+                 from added as d inner join post_favorites as f
+                 on f.favorited_user = d.favorited_user and f.post_id <> d.post_id
+                 inner join sym_similarity as s
+                 on s.low_id = least(d.post_id, f.post_id)
+                 and s.high_id = greatest(d.post_id, f.post_id)
+                 where d.recorded > coalesce(s.computed, 0)
+                 group by 1, 2
+                 union all
+                 select s.low_id, s.high_id, -count(distinct d.favorited_user)
+                 from removed as d inner join previous as f
+                 on f.favorited_user = d.favorited_user and f.post_id <> d.post_id
+                 inner join sym_similarity as s
+                 on s.low_id = least(d.post_id, f.post_id)
+                 and s.high_id = greatest(d.post_id, f.post_id)
+                 where d.recorded > coalesce(s.computed, 0)
+                 group by 1, 2),
+            pairs as
+                (select low_id, high_id, sum(n) as gained from changes
+                 group by low_id, high_id having sum(n) <> 0),
+            counts as
+                (select pairs.low_id, pairs.high_id,
+                        greatest(0, s.common + pairs.gained)::integer as common,
+                        a.fav_count as low_favs, b.fav_count as high_favs
+                 from pairs
+                 inner join sym_similarity as s
+                 on s.low_id = pairs.low_id and s.high_id = pairs.high_id
+                 inner join posts as a on a.id = pairs.low_id
+                 inner join posts as b on b.id = pairs.high_id)
+            update sym_similarity as s set
+                common = c.common,
+                low_favs = c.low_favs,
+                high_favs = c.high_favs,
+                add_sim = least(1.0, c.common::real /
+                    greatest(1, c.low_favs + c.high_favs - c.common)),
+                mult_sim = least(1.0, (c.common::real)^2 /
+                    greatest(1, c.low_favs * c.high_favs))
+            from counts as c
+            where s.low_id = c.low_id and s.high_id = c.high_id
+            returning s.low_id, s.high_id
+            ''',
+            (cutoff,))
+        pairs = self.c.fetchall()
+
+        self.c.execute('''delete from favorites_delta where recorded <= %s''',
+                       (cutoff,))
+        self.conn.commit()
+
+        touched = set(p[0] for p in pairs) | set(p[1] for p in pairs)
+        self.c.execute('''select distinct source_id from post_similars
+                          where source_id = any(%s)''',
+                       (list(touched),))
+        rerank = [r[0] for r in self.c.fetchall()]
+        for source_id in rerank:
+            self.rerank_similars(source_id)
+
+        status = 'Updated {:,} pairs, re-ranked {:,} posts in {}.'.format(
+            len(pairs), len(rerank), seconds_to_dhms(time.time()-start))
+        print(status)
+        return status
+
+    # histograms for stats. materialized, so reading them is cheap;
+    # see refresh_stats.
+    STATS_VIEWS = {
+        'stats_favcount': ('fav_count', '''
+            select fav_count, count(*) as posts from posts
+            where fav_count is not null group by fav_count'''),
+        'stats_user_degree': ('degree', '''
+            select degree, count(*) as users from
+            (select count(*) as degree from post_favorites
+             group by favorited_user) as degrees
+            group by degree'''),
+        'stats_tag_count': ('tag_count', '''
+            select count as tag_count, count(*) as tags from tags
+            where count is not null group by count'''),
+    }
+
+    def refresh_stats(self):
+        '''
+        Creates or refreshes the materialized stats views.
+        After the first time, refreshes don't block readers.
+        '''
+        self.pin_primary()
+        for view, (key, query) in self.STATS_VIEWS.items():
+            start = time.time()
+            self.c.execute('''CREATE MATERIALIZED VIEW IF NOT EXISTS {} AS {}
+                              WITH NO DATA'''.format(view, query))
+            # concurrent refreshes need a unique index
+            self.c.execute('''CREATE UNIQUE INDEX IF NOT EXISTS {0}_key
+                              on {0}({1})'''.format(view, key))
+            self.c.execute('''select ispopulated from pg_matviews
+                              where matviewname = %s''',
+                           (view,))
+            populated = self.c.fetchall()[0][0]
+            self.c.execute('''REFRESH MATERIALIZED VIEW {} {}'''.format(
+                'CONCURRENTLY' if populated else '', view))
+            self.conn.commit()
+            print('Refreshed {} in {}.'.format(
+                view, seconds_to_dhms(time.time()-start)))
+
+    def get_histogram(self, view):
+        '''
+        returns (value, quantity) pairs of a stats view, by value,
+        or none if the view was never refreshed (see refresh_stats).
+        '''
+        key = self.STATS_VIEWS[view][0]
+        if not self.read('''select 1 from pg_matviews
+                            where matviewname = %s and ispopulated''', (view,)):
+            return []
+        return self.read('''select * from {} order by {}'''.format(view, key))
+
     def get_favcount_stats(self, fav_count):
-        self.c.execute('''select count(*) from posts where fav_count=%s''',
+        rows = self.read('''select count(*) from posts where fav_count=%s''',
                        (fav_count,))
-        return self.c.fetchall()[0][0]
+        return rows[0][0]
 
     def get_favcount(self, post_id):
-        self.c.execute('''select fav_count from posts where id=%s''',
+        rows = self.read('''select fav_count from posts where id=%s''',
                         (post_id,))
-        return self.c.fetchall()[0][0]
+        return rows[0][0]
 
     def have_favs_for_id(self, source_id):
         '''
         returns boolean reflecting whether the source has had its favorites recorded.
         '''
-        self.c.execute('''
+        return self.read('''
                        select * from favorites_meta where post_id = %s
                        ''',
                        (source_id,))
-        return self.c.fetchall()
 
     def have_post_for_id(self, source_id):
         '''
         returns boolean reflecting whether the post is in the posts table.
         '''
-        self.c.execute('''
+        return self.read('''
                        select * from posts where id = %s
                        ''',
                        (source_id,))
-        return self.c.fetchall()
 
     def get_overlap(self, a, b):
         '''
         Returns the quantity of users who favorited both post a and b.
         '''
-        self.c.execute(
+        rows = self.read(
             '''
             select count(favorited_user) from post_favorites
             where post_id = %s and favorited_user in
@@ -466,11 +1805,130 @@ class Database():
             )
             ''',
             (a, b,))
-        return self.c.fetchall()[0][0]
+        return rows[0][0]
 
     def get_post(self, id):
+        '''
+        Fetches a post (and those before it on its page).
+        Posts known to be missing are skipped; see is_known_missing.
+        Returns boolean reflecting whether the post was found.
+        '''
+        if self.is_known_missing(id):
+            return False
+
         self.get_all_posts(before_id=id+2, stop_count=1)
 
+        if self.have_post_for_id(id):
+            self.c.execute('''delete from missing_posts where post_id = %s''',
+                           (id,))
+            return True
+        # possible if deleted
+        print("NOTICE: ID {} does not exist".format(id))
+        self.mark_missing(id)
+        return False
+
+    def is_known_missing(self, id):
+        '''
+        returns boolean reflecting whether the post was recently found
+        not to exist. see known_missing.
+        '''
+        return id in self.known_missing([id])
+
+    def known_missing(self, ids):
+        '''
+        returns the set of ids among ids recently found not to exist,
+        counting a skip for each. "recently" doubles with each failed check,
+        from MISSING_RETRY_TIME up to MISSING_RETRY_MAX.
+        Left uncommitted, as part of the caller's transaction.
+        '''
+        self.pin_primary()
+        self.c.execute('''
+                       update missing_posts set skips = skips + 1
+                       where post_id = any(%s) and last_checked +
+                       least(%s * 2 ^ (checks - 1), %s) > %s
+                       returning post_id
+                       ''',
+                       (list(ids), constants.MISSING_RETRY_TIME,
+                        constants.MISSING_RETRY_MAX, time.time()))
+        return {r[0] for r in self.c.fetchall()}
+
+    def mark_missing(self, id):
+        self.pin_primary()
+        now = time.time()
+        self.c.execute('''
+                       insert into missing_posts values (%s, %s, %s, 1, 0)
+                       ON CONFLICT (post_id) DO UPDATE SET
+                       last_checked = EXCLUDED.last_checked,
+                       checks = missing_posts.checks + 1
+                       ''',
+                       (id, now, now))
+        self.conn.commit()
+
+    def hydrate(self, post_ids):
+        '''
+        Fetches every post and favorites list among post_ids not yet in
+        the database, so that computations over them need no remote access.
+
+        Missing posts are fetched by page: ids close enough together to
+        fit on one page share a single request. Favorites can only be
+        fetched one post at a time. Posts not found are marked missing.
+        Returns (posts fetched, favorites lists fetched).
+        '''
+        start = time.time()
+        post_ids = list(set(post_ids))
+
+        self.c.execute('''select id from unnest(%s::integer[]) as id
+                          where id not in (select id from posts)''',
+                       (post_ids,))
+        absent = [r[0] for r in self.c.fetchall()]
+        skipped = self.known_missing(absent)
+        absent = sorted([id for id in absent if id not in skipped], reverse=True)
+
+        # a page holds the PAGE_SIZE posts below before_id, so it holds
+        # every id within PAGE_SIZE of the highest wanted
+        found = set()
+        pages = 0
+        while absent:
+            high = absent[0]
+            window = [id for id in absent if id > high - PAGE_SIZE]
+            absent = absent[len(window):]
+
+            j = self.api.posts_page(high + 1)
+            pages += 1
+            if j:
+                self.save_posts(j, updated=time.time())
+                found.update(p['id'] for p in j)
+            for id in window:
+                if id not in found:
+                    print("NOTICE: ID {} does not exist".format(id))
+                    self.mark_missing(id)
+        self.conn.commit()
+
+        self.c.execute('''select id from unnest(%s::integer[]) as id
+                          where id in (select id from posts)
+                          and id not in (select post_id from favorites_meta)''',
+                       (post_ids,))
+        no_favs = [r[0] for r in self.c.fetchall()]
+        for id in no_favs:
+            self.get_favs(id)
+            self.conn.commit()
+
+        if pages or no_favs:
+            print('Hydrated {} posts in {} pages and {} favorites in {}.'.format(
+                len(found & set(post_ids)), pages, len(no_favs),
+                seconds_to_dhms(time.time()-start)))
+        return len(found & set(post_ids)), len(no_favs)
+
+    def missing_stats(self):
+        '''
+        returns (posts known missing, fetches skipped, seconds saved).
+        saved time is estimated from PAGE_DELAY, the least a fetch takes.
+        '''
+        self.c.execute('''select count(*), coalesce(sum(skips), 0)
+                          from missing_posts''')
+        count, skips = self.c.fetchall()[0]
+        return count, skips, skips * constants.PAGE_DELAY
+
     def calc_and_put_sym_sim(self, low_id, high_id, verbose=False):
         '''
         Computes and inserts into the database the symmetric similarity between
@@ -486,15 +1944,12 @@ class Database():
         badpair = False
 
         for id in [a,b]:
-            if not self.have_favs_for_id(id):
-                self.get_favs(id)
             if not self.have_post_for_id(id):
-                self.get_post(id)
-
-                # possible if deleted
-                if not self.have_post_for_id(id):
-                    print("NOTICE: ID {} does not exist".format(id))
+                if not self.get_post(id):
                     badpair=True
+                    continue
+            if not self.have_favs_for_id(id):
+                self.get_favs(id)
 
         if badpair:
             # skip this pair
@@ -525,23 +1980,45 @@ class Database():
             print("MULT_SIM FOR {}, {} IS > 1  ({})".format(a, b, mult_sim))
             mult_sim = 1
 
-        self.write_sym_sim_row(low_id, high_id, overlap, add_sim, mult_sim)
+        self.write_sym_sim_row(low_id, high_id, overlap, add_sim, mult_sim,
+                               b_favs, a_favs)
         return 0
 
-    def write_sym_sim_row(self, low_id, high_id, overlap, add_sim, mult_sim):
+    def write_sym_sim_row(self, low_id, high_id, overlap, add_sim, mult_sim,
+                          low_favs=None, high_favs=None):
+        self.pin_primary()
         self.c.execute('''
-                       insert into sym_similarity values
-                       (%s, %s, %s, %s, %s)
+                       insert into sym_similarity
+                       (low_id, high_id, common, add_sim, mult_sim, low_favs, high_favs,
+                        computed)
+                       values (%s, %s, %s, %s, %s, %s, %s, %s)
                        ON CONFLICT (low_id, high_id) DO UPDATE SET
                        common = EXCLUDED.common,
                        add_sim = EXCLUDED.add_sim,
-                       mult_sim = EXCLUDED.mult_sim
+                       mult_sim = EXCLUDED.mult_sim,
+                       low_favs = EXCLUDED.low_favs,
+                       high_favs = EXCLUDED.high_favs,
+                       computed = EXCLUDED.computed
                        ''',
-                       (low_id, high_id, overlap, add_sim, mult_sim))
+                       (low_id, high_id, overlap, add_sim, mult_sim,
+                        low_favs, high_favs, int(time.time())))
+
+
 
 
 
+def _update_subset_partition(partition):
+    return Database().update_favorites_subset(partition=partition)
 
+def update_favorites_subset_parallel(workers=4):
+    '''
+    Rebuilds favorites_subset with one process per partition of
+    post_favorites, up to workers at a time.
+    '''
+    partitions = Database().favorites_partitions()
+    with multiprocessing.Pool(workers) as pool:
+        statuses = pool.map(_update_subset_partition, partitions)
+    return '\n'.join(statuses)
 
 
 def main():
@@ -553,6 +2030,8 @@ def main():
     #db.get_newer_posts()
 
     db.sample_favs()
+    db.update_similarity_deltas()
+    db.refresh_user_degrees()
 
     db.update_favorites_subset()
 
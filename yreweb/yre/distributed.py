@@ -0,0 +1,158 @@
+'''
+Similars computed across any number of hosts.
+
+The coordinator splits the posts needing similars into work units, rows
+of the work_units table. Workers, on any host that can reach the database,
+lease a unit at a time (claimed with SKIP LOCKED, so no two get the same
+one), compute its posts and write their similars in one transaction with
+the unit's completion. A worker renews its lease every WORK_HEARTBEAT
+seconds; a unit whose worker stops renewing for WORK_LEASE_TIMEOUT seconds
+is handed to the next claimer, and the first worker's results are dropped.
+
+Workers keep no state of their own, so adding capacity is starting more
+of them, anywhere.
+
+Usage:
+    python distributed.py coordinate [dirty]   queue posts needing similars
+                                               (and stale ones, with dirty)
+    python distributed.py work [processes]     work until no units remain
+    python distributed.py status
+'''
+import os
+import sys
+import time
+import socket
+import threading
+import multiprocessing
+
+try:
+    from .database import Database
+    from .analysis import compute_similar
+    from .utilities import *
+    from . import constants
+except ImportError:
+    from database import Database
+    from analysis import compute_similar
+    from utilities import *
+    import constants
+
+
+def coordinate(dirty=False, unit_size=constants.WORK_UNIT_SIZE):
+    '''
+    Queues work units for every post needing similars,
+    and if dirty, every post whose similars are stale.
+    '''
+    db = Database()
+    db.init_db()
+    print('Searching for posts needing similars computed...')
+    post_ids = db.find_similar_need_update()
+    if dirty:
+        post_ids += db.find_dirty_similars()
+    units = db.create_work_units(post_ids, unit_size)
+    print('Queued {} work units for {} posts.'.format(units, len(post_ids)))
+
+
+class Heartbeat(threading.Thread):
+    '''
+    Renews the lease of a unit until stopped.
+    lost is set if the unit was reclaimed meanwhile.
+    '''
+    def __init__(self, unit_id, worker, interval=constants.WORK_HEARTBEAT):
+        super().__init__(daemon=True)
+        self.unit_id = unit_id
+        self.worker = worker
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.lost = threading.Event()
+
+    def run(self):
+        # a connection of its own, as the worker's is busy computing
+        db = Database()
+        while not self.stopped.wait(self.interval):
+            if not db.heartbeat_work_unit(self.unit_id, self.worker):
+                self.lost.set()
+                return
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def run_worker(worker=None, exit_when_idle=True):
+    '''
+    Claims and computes work units until none remain (or forever, if not
+    exit_when_idle). Returns the quantity of units completed.
+    '''
+    worker = worker or '{}:{}'.format(socket.gethostname(), os.getpid())
+    db = Database()
+    completed = 0
+
+    while True:
+        claimed = db.claim_work_unit(worker)
+        if not claimed:
+            queued, leased, done, failed = db.count_work_units()
+            if exit_when_idle and not queued and not leased:
+                break
+            time.sleep(constants.WORK_POLL)
+            continue
+
+        unit_id, post_ids = claimed
+        start = time.time()
+        heartbeat = Heartbeat(unit_id, worker)
+        heartbeat.start()
+
+        pending = []
+        for id in post_ids:
+            if heartbeat.lost.is_set():
+                break
+            try:
+                compute_similar(id, pending=pending)
+            except Exception as e:
+                # one bad post shouldn't cost the whole unit
+                print('{}: computing {} failed: {!r}'.format(worker, id, e))
+        heartbeat.stop()
+
+        if heartbeat.lost.is_set():
+            print('{}: lost unit {}, discarding.'.format(worker, unit_id))
+            continue
+
+        db.write_similar_rows(pending, commit=False)
+        if db.finish_work_unit(unit_id, worker):
+            completed += 1
+            print('{}: unit {} ({} posts) done in {}.'.format(
+                worker, unit_id, len(pending), seconds_to_dhms(time.time()-start)))
+        else:
+            print('{}: unit {} was reclaimed, discarding.'.format(worker, unit_id))
+
+    print('{}: no work left. {} units completed.'.format(worker, completed))
+    return completed
+
+
+def run_workers(processes=4):
+    '''
+    Runs workers in several processes on this host.
+    '''
+    procs = [multiprocessing.Process(target=run_worker)
+             for i in range(processes)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+
+
+def status():
+    queued, leased, done, failed = Database().count_work_units()
+    print('{} queued, {} leased, {} done, {} given up on.'.format(
+        queued, leased, done, failed))
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if args and args[0] == 'coordinate':
+        coordinate(dirty='dirty' in args[1:])
+    elif args and args[0] == 'work':
+        run_workers(int(args[1]) if len(args) > 1 else 1)
+    elif args and args[0] == 'status':
+        status()
+    else:
+        print(__doc__)
@@ -9,6 +9,7 @@ from pathlib import Path
 from shutil import copyfile
 
 import time
+import asyncio
 
 try:
     from database import Database
@@ -19,6 +20,16 @@ except ModuleNotFoundError:
 
 import urllib
 
+self_path = dirname(abspath(inspect.getfile(inspect.currentframe())))
+previews_path = str(Path(self_path).parent) + '/static/yreweb/previews/'
+error_path = str(Path(self_path).parent) + '/static/yreweb/error.jpg'
+
+def local_path(post_id):
+    '''
+    Returns the path a post's preview is cached at, whether or not it exists.
+    '''
+    return previews_path + str(post_id) + '.jpg'
+
 def get_local(post_id, return_type='filename'):
     '''
     For a post id (12345), return its filename ('12345.jpg') as stored locally,
@@ -26,13 +37,10 @@ def get_local(post_id, return_type='filename'):
 
     TODO: animation support
     '''
-    self_path = dirname(abspath(inspect.getfile(inspect.currentframe())))
-    previews_path = str(Path(self_path).parent) + '/static/yreweb/previews/'
-    error_path = str(Path(self_path).parent) + '/static/yreweb/error.jpg'
     makedirs(previews_path, exist_ok=True)
 
     filename = str(post_id) + '.jpg'
-    local_image = previews_path + filename
+    local_image = local_path(post_id)
 
     if isfile(local_image):
         if return_type == 'filename':
@@ -41,12 +49,20 @@ def get_local(post_id, return_type='filename'):
             return (filename, 1)
 
     db = Database()
-    urls = db.get_urls_for_ids([post_id])
+    urls = db.get_urls_for_ids([post_id]) if post_id else ['']
     file_url = urls[0]
+    if not file_url:
+        # unknown post, or 0 (padding). nothing to download or cache.
+        print('No preview url for', post_id)
+        if return_type == 'filename':
+            return filename
+        elif return_type == 'cachehit':
+            return (filename, 1)
 
     prefix = 'https://static1.e621.net/data/'
     probable_sample_url = prefix + 'sample/' + file_url[len(prefix):-3] + 'jpg'
 
+    db.throttle(constants.REQUEST_DELAY)
     try:
         urllib.request.urlopen(file_url)
         # success! time to download
@@ -60,9 +76,15 @@ def get_local(post_id, return_type='filename'):
                     attempt + 1, post_id
                 ))
                 time.sleep(0.2*1.5**attempt)
-    except urllib.error.HTTPError:
-        print('Could not download preview for', post_id)
-        copyfile(error_path,local_image)
+    except urllib.error.HTTPError as e:
+        db.report(e.code)
+        print('Could not download preview for {}: {}'.format(post_id, e.code))
+        if e.code in (404, 410):
+            # gone for good, so cached as an error
+            copyfile(error_path,local_image)
+    except urllib.error.URLError as e:
+        # likely transient, so not cached as an error
+        print('Could not reach preview for {}: {}'.format(post_id, e.reason))
     if return_type == 'filename':
         return filename
     elif return_type == 'cachehit':
@@ -82,7 +104,27 @@ def image_with_delay(post_id):
 
 
     name, hit = r
-    if not hit:
+    if not hit and Database.limiter is None:
         while time.time() - start < constants.REQUEST_DELAY:
             time.sleep(0.01)
     return name
+
+async def image_async(post_id):
+    '''
+    As image_with_delay, without blocking the event loop:
+    the download runs in a worker thread and waits are awaited.
+    '''
+    loop = asyncio.get_running_loop()
+    start = time.time()
+    r = []
+    i = 0
+    while not r:
+        r = await loop.run_in_executor(None, get_local, post_id, 'cachehit')
+        if not r:
+            await asyncio.sleep(constants.REQUEST_DELAY * 2**i)
+            i += 1
+
+    name, hit = r
+    if not hit and Database.limiter is None:
+        await asyncio.sleep(max(0, constants.REQUEST_DELAY - (time.time() - start)))
+    return name
@@ -0,0 +1,85 @@
+'''
+Symmetric similarity metrics, computed at query time.
+
+Every metric is a function of a pair's sufficient statistics:
+    common   quantity of users who favorited both posts
+    a, b     favorite counts of each post
+    total    quantity of users in the dataset
+sym_similarity stores the first three (common, low_favs, high_favs),
+so any metric here can rank stored pairs without recomputing them.
+
+Functions take numpy arrays (or scalars) and return arrays of scores,
+higher being more similar. Register new ones in METRICS.
+'''
+import numpy as np
+
+try:
+    from . import constants
+except ImportError:
+    import constants
+
+
+def add_sim(common, a, b, total):
+    # Jaccard: both / either. see analysis.sym_sims
+    return np.minimum(common / np.maximum(a + b - common, 1), 1)
+
+def mult_sim(common, a, b, total):
+    # product of the shared fraction of each post. see analysis.sym_sims
+    return np.minimum(common**2 / np.maximum(a * b, 1), 1)
+
+def cosine(common, a, b, total):
+    return np.minimum(common / np.sqrt(np.maximum(a * b, 1)), 1)
+
+def lift(common, a, b, total):
+    # how many times more often the posts are favorited together
+    # than if users favorited independently
+    return common * total / np.maximum(a * b, 1)
+
+def pmi(common, a, b, total):
+    # pointwise mutual information, log of lift. pairs with nothing
+    # in common get the least score rather than -inf
+    return np.log(np.maximum(lift(common, a, b, total), 1e-9))
+
+def shrunk_jaccard(common, a, b, total):
+    # Jaccard pulled towards 0 for pairs with few favorites,
+    # whose overlap says little
+    return common / (np.maximum(a + b - common, 1) + constants.METRIC_SHRINKAGE)
+
+
+METRICS = {
+    'add_sim': add_sim,
+    'mult_sim': mult_sim,
+    'cosine': cosine,
+    'lift': lift,
+    'pmi': pmi,
+    'shrunk_jaccard': shrunk_jaccard,
+}
+
+# metrics needing the quantity of users
+NEEDS_TOTAL = {'lift', 'pmi'}
+
+
+def score(metric, common, a, b, total=1):
+    '''
+    Returns the scores of the given metric, as a float array.
+    '''
+    if metric not in METRICS:
+        raise ValueError('unknown similarity metric {!r} (one of {})'.format(
+            metric, ', '.join(METRICS)))
+    return METRICS[metric](np.asarray(common, dtype=np.float64),
+                           np.asarray(a, dtype=np.float64),
+                           np.asarray(b, dtype=np.float64),
+                           total)
+
+
+def score_rows(metric, rows, total=1):
+    '''
+    Scores sym_similarity rows of
+    (low_id, high_id, common, add_sim, mult_sim, low_favs, high_favs),
+    as returned by Database.select_n_similar.
+    '''
+    if not rows:
+        return np.zeros(0)
+    common, a, b = np.array([(r[2], r[5] or 0, r[6] or 0) for r in rows],
+                            dtype=np.float64).T
+    return score(metric, common, a, b, total)
@@ -0,0 +1,182 @@
+import os
+import time
+import threading
+import multiprocessing
+
+import psycopg2
+
+try:
+    from . import constants
+except ImportError:
+    import constants
+
+# priority classes. interactive requests (the web app) go ahead of batch
+# ones (crawls, presampling): they take the next free slot outright, while
+# batch requests only take a slot once it is free.
+INTERACTIVE = 0
+BATCH = 1
+
+default_priority = BATCH
+
+def set_priority(priority):
+    '''
+    Sets the priority of this process's requests.
+    '''
+    global default_priority
+    default_priority = priority
+
+# responses that mean we are going too fast
+BACKOFF_STATUSES = [421, 429, 500, 502, 503, 520, 522, 524, 525]
+MAX_BACKOFF = 32
+
+
+class RateLimiter():
+    '''
+    Spaces out remote requests so that, across everyone holding the same
+    limiter, no two requests start closer together than the given delay.
+
+    The limiter keeps a single "next free slot" timestamp behind a lock.
+    With shared=True both live in shared memory, so a limiter created in a
+    parent process may be handed to worker processes and they will all draw
+    from one budget.
+
+    Delays are stretched by a backoff factor, which doubles on every error
+    response reported and decays back to 1 on success.
+    '''
+    def __init__(self, shared=False):
+        if shared:
+            self.lock = multiprocessing.Lock()
+        else:
+            self.lock = threading.Lock()
+        self.next_slot = multiprocessing.Value('d', 0.0, lock=False)
+        self.backoff = multiprocessing.Value('d', 1.0, lock=False)
+
+    def wait(self, delay, priority=None):
+        '''
+        Blocks until this caller may make a request, then reserves the
+        following delay seconds.
+        '''
+        if priority is None:
+            priority = default_priority
+
+        while True:
+            with self.lock:
+                now = time.time()
+                slot = self.next_slot.value
+                if priority == INTERACTIVE or slot <= now:
+                    slot = max(now, slot)
+                    self.next_slot.value = slot + delay * self.backoff.value
+                    break
+            # batch: let the slot come up, then compete for it again
+            time.sleep(min(slot - now, 0.05))
+
+        if slot > now:
+            time.sleep(slot - now)
+
+    def report(self, status_code):
+        '''
+        Adjusts the backoff factor according to a response status.
+        '''
+        with self.lock:
+            if status_code in BACKOFF_STATUSES:
+                self.backoff.value = min(self.backoff.value * 2, MAX_BACKOFF)
+            elif self.backoff.value > 1:
+                self.backoff.value = max(self.backoff.value * 0.9, 1)
+
+
+class PgRateLimiter():
+    '''
+    As RateLimiter, but the budget is a row of the rate_budget table, so it
+    is shared by every process using the database: crawlers, presamplers
+    and web workers alike, on any host. Times come from the database clock.
+
+    Each process has one connection to the budget, which its threads take
+    turns on: the row lock serializes transactions, not the threads sharing one.
+    '''
+    def __init__(self, name='e621'):
+        self.name = name
+        self._reset()
+        # a lock held by another thread at fork time would never be released
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self.conn = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # connections can't cross processes; each opens its own
+        return {'name': self.name}
+
+    def __setstate__(self, state):
+        self.name = state['name']
+        self._reset()
+
+    def connect(self):
+        if self.conn is None or self.pid != os.getpid():
+            self.conn = psycopg2.connect("dbname='{}' user='{}' password='{}' host='{}'".format(
+                constants.DB_NAME, constants.DB_USER, constants.DB_PASSWORD, constants.DB_HOST
+            ))
+            self.pid = os.getpid()
+            c = self.conn.cursor()
+            c.execute('''CREATE TABLE IF NOT EXISTS rate_budget
+                         (name text primary key, next_slot double precision,
+                         backoff double precision)''')
+            c.execute('''insert into rate_budget values (%s, 0, 1)
+                         ON CONFLICT DO NOTHING''',
+                      (self.name,))
+            self.conn.commit()
+        return self.conn.cursor()
+
+    def wait(self, delay, priority=None):
+        if priority is None:
+            priority = default_priority
+
+        while True:
+            # the row lock serializes everyone on this budget,
+            # and self.lock the threads of this process
+            with self.lock:
+                c = self.connect()
+                c.execute('''select next_slot, backoff,
+                             extract(epoch from clock_timestamp())
+                             from rate_budget where name = %s for update''',
+                          (self.name,))
+                slot, backoff, now = c.fetchall()[0]
+                if priority == INTERACTIVE or slot <= now:
+                    slot = max(now, slot)
+                    c.execute('''update rate_budget set next_slot = %s
+                                 where name = %s''',
+                              (slot + delay * backoff, self.name))
+                    self.conn.commit()
+                    break
+                self.conn.commit()
+            time.sleep(min(slot - now, 0.05))
+
+        if slot > now:
+            time.sleep(slot - now)
+
+    def report(self, status_code):
+        with self.lock:
+            c = self.connect()
+            if status_code in BACKOFF_STATUSES:
+                c.execute('''update rate_budget set backoff = least(backoff * 2, %s)
+                             where name = %s''',
+                          (MAX_BACKOFF, self.name))
+            else:
+                c.execute('''update rate_budget set backoff = greatest(backoff * 0.9, 1)
+                             where name = %s and backoff > 1''',
+                          (self.name,))
+            self.conn.commit()
+
+
+_default = None
+
+def default_limiter():
+    '''
+    Returns the limiter shared by everything in this process,
+    or None if SHARED_RATE_LIMIT is off.
+    '''
+    global _default
+    if _default is None and constants.SHARED_RATE_LIMIT:
+        _default = PgRateLimiter()
+    return _default
@@ -0,0 +1,134 @@
+'''
+Remote access to e621.
+
+E621Api performs requests, paced by a rate limiter.
+LocalApi answers the same calls from memory, standing in for e621
+in tests and benchmarks (see Database.api).
+'''
+import requests
+from requests.packages.urllib3.util.retry import Retry
+from requests.adapters import HTTPAdapter
+import json
+
+try:
+    from . import constants
+    from .ratelimit import RateLimiter, BACKOFF_STATUSES
+except ImportError:
+    import constants
+    from ratelimit import RateLimiter, BACKOFF_STATUSES
+
+POSTS_URL = 'https://e621.net/post/index.json'
+FAVORITES_URL = 'https://e621.net/favorite/list_users.json'
+PAGE_SIZE = 320  # most posts per page the api allows
+STATUS_RETRIES = 5  # attempts at a request answered with a backoff status
+
+
+def make_session():
+    '''
+    Returns a requests session set up for e621 access.
+    '''
+    s = requests.session()
+    s.headers.update({'user-agent': constants.USER_AGENT})
+
+    # connection errors only. error statuses are retried by E621Api
+    # through the rate limiter, which backs off on seeing them
+    retries = Retry(
+        total=3,
+        backoff_factor=1,
+        status_forcelist=[],
+        raise_on_status=False
+        )
+    s.mount('http://', HTTPAdapter(max_retries=retries))
+    s.mount('https://', HTTPAdapter(max_retries=retries))
+    return s
+
+
+class E621Api():
+    '''
+    Without a limiter, requests are paced by one private to this instance.
+    '''
+    def __init__(self, limiter=None, session=None):
+        self.limiter = limiter or RateLimiter()
+        self.s = session or make_session()
+
+    def wait(self, delay):
+        self.limiter.wait(delay)
+
+    def report(self, status_code):
+        self.limiter.report(status_code)
+
+    def _get(self, url, params, delay, timeout=None):
+        # every response is reported, so that error statuses slow the
+        # limiter down before the retry waits on it
+        for attempt in range(STATUS_RETRIES):
+            self.wait(delay)
+            r = self.s.get(url, params=params, timeout=timeout)
+            self.report(r.status_code)
+            if r.status_code not in BACKOFF_STATUSES:
+                break
+            print('Got {} from {}, retrying ({}/{}).'.format(
+                r.status_code, url, attempt + 1, STATUS_RETRIES))
+        else:
+            r.raise_for_status()
+        return json.loads(r.text)
+
+    def posts_page(self, before_id=None, limit=PAGE_SIZE):
+        '''
+        Returns up to limit posts with ids below before_id, newest first.
+        '''
+        return self._get(POSTS_URL,
+                         {'before_id': before_id, 'limit': str(limit)},
+                         constants.PAGE_DELAY)
+
+    def favorite_users(self, id):
+        '''
+        Returns the names of the users who favorited a post,
+        or None if they could not be retrieved.
+        '''
+        j = self._get(FAVORITES_URL, {'id': id}, constants.REQUEST_DELAY,
+                      constants.FAV_REQ_TIMEOUT)
+        if 'favorited_users' not in j:
+            return None
+        return [u for u in j['favorited_users'].split(',') if u]
+
+
+class LocalApi():
+    '''
+    Serves posts and favorites from dicts, without pacing:
+    posts maps id to a post dict as e621 returns it,
+    favorites maps id to a list of user names.
+    Counts the requests made, by kind.
+    '''
+    def __init__(self, posts=None, favorites=None):
+        self.posts = posts or {}
+        self.favorites = favorites or {}
+        self.requests = {'posts_page': 0, 'favorite_users': 0}
+
+    @classmethod
+    def from_files(cls, posts_path, favorites_path=None):
+        '''
+        Loads a json list of posts, and a json object of post id to users.
+        '''
+        with open(posts_path) as f:
+            posts = {p['id']: p for p in json.load(f)}
+        favorites = {}
+        if favorites_path:
+            with open(favorites_path) as f:
+                favorites = {int(k): v for k, v in json.load(f).items()}
+        return cls(posts, favorites)
+
+    def wait(self, delay):
+        pass
+
+    def report(self, status_code):
+        pass
+
+    def posts_page(self, before_id=None, limit=PAGE_SIZE):
+        self.requests['posts_page'] += 1
+        ids = sorted((id for id in self.posts
+                      if before_id is None or id < before_id), reverse=True)
+        return [self.posts[id] for id in ids[:limit]]
+
+    def favorite_users(self, id):
+        self.requests['favorite_users'] += 1
+        return self.favorites.get(id)
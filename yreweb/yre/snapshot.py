@@ -0,0 +1,165 @@
+'''
+Columnar snapshots of the dataset.
+
+Exports tables to zstd-compressed Parquet files, one per table, streaming
+them through server-side cursors so memory use does not grow with table size.
+Importing loads the files back with COPY.
+
+Usage:
+    python snapshot.py export <directory> [table ...]
+    python snapshot.py import <directory> [table ...]
+
+Requires pyarrow.
+'''
+import io
+import os
+import sys
+import time
+import itertools
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+try:
+    from .database import Database
+    from .utilities import *
+    from . import constants
+except ImportError:
+    from database import Database
+    from utilities import *
+    import constants
+
+CHUNK_ROWS = 100000
+
+if pa is not None:
+    SCHEMAS = {
+        'posts': pa.schema([
+            ('id', pa.int32()), ('status', pa.string()),
+            ('fav_count', pa.int32()), ('score', pa.int32()),
+            ('rating', pa.string()), ('uploaded', pa.int64()),
+            ('updated', pa.int64()), ('md5', pa.string()),
+            ('full_url', pa.string()), ('sample_url', pa.string()),
+            ('preview_url', pa.string())]),
+        'tags': pa.schema([
+            ('id', pa.int32()), ('name', pa.string()),
+            ('count', pa.int32()), ('type', pa.int32())]),
+        'post_tags': pa.schema([
+            ('post_id', pa.int32()), ('tag_id', pa.int32())]),
+        'post_favorites': pa.schema([
+            ('post_id', pa.int32()), ('favorited_user', pa.string()),
+            ('sample_key', pa.int32())]),
+        'post_similars': pa.schema([
+            ('source_id', pa.int32()), ('updated', pa.int64()),
+            ('sim_post', pa.int32()), ('sim_rank', pa.int32())]),
+    }
+else:
+    SCHEMAS = {}
+
+TABLES = ['posts', 'tags', 'post_tags', 'post_favorites', 'post_similars']
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError('snapshots require pyarrow (pip install pyarrow)')
+
+
+def export_table(db, table, directory, itersize=constants.STREAM_ITERSIZE):
+    '''
+    Streams one table into <directory>/<table>.parquet.
+    Returns the quantity of rows written.
+    '''
+    _require_pyarrow()
+    schema = SCHEMAS[table]
+    path = os.path.join(directory, table + '.parquet')
+
+    # rows arrive itersize at a time, written a batch each
+    stream = db.stream('select {} from {}'.format(', '.join(schema.names), table),
+                       itersize=itersize)
+
+    rows = 0
+    with pq.ParquetWriter(path, schema, compression='zstd') as writer:
+        while True:
+            chunk = list(itertools.islice(stream, itersize))
+            if not chunk:
+                break
+            columns = list(zip(*chunk))
+            batch = pa.RecordBatch.from_arrays(
+                [pa.array(col, type=field.type)
+                 for col, field in zip(columns, schema)],
+                schema=schema)
+            writer.write_batch(batch)
+            rows += len(chunk)
+            print('{}: {:,} rows'.format(table, rows))
+    return rows
+
+
+def import_table(db, table, directory, chunk_rows=CHUNK_ROWS, replace=True):
+    '''
+    Loads <directory>/<table>.parquet into its table using COPY.
+    If replace, the table is emptied first.
+    Returns the quantity of rows loaded.
+    '''
+    _require_pyarrow()
+    path = os.path.join(directory, table + '.parquet')
+    # the file's own columns, as snapshots older than a column lack it
+    names = pq.ParquetFile(path).schema_arrow.names
+    copy_sql = 'COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(
+        table, ', '.join(names))
+
+    if replace:
+        db.c.execute('truncate {}'.format(table))
+
+    rows = 0
+    options = pyarrow.csv.WriteOptions(include_header=False)
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_rows):
+        buf = io.BytesIO()
+        pyarrow.csv.write_csv(batch, buf, options)
+        buf.seek(0)
+        db.c.copy_expert(copy_sql, buf)
+        rows += batch.num_rows
+        print('{}: {:,} rows'.format(table, rows))
+
+    if table == 'tags':
+        # ids were loaded explicitly, so move the sequence past them
+        db.c.execute('''select setval('tags_id_seq', coalesce(max(id), 0) + 1, false)
+                        from tags''')
+    if table == 'post_favorites' and 'sample_key' not in names:
+        db.rekey_favorites(commit=False)
+    db.conn.commit()
+    return rows
+
+
+def export_snapshot(directory, tables=TABLES):
+    os.makedirs(directory, exist_ok=True)
+    db = Database()
+    for table in tables:
+        start = time.time()
+        rows = export_table(db, table, directory)
+        print('Exported {} ({:,} rows) in {}.'.format(
+            table, rows, seconds_to_dhms(time.time()-start)))
+
+
+def import_snapshot(directory, tables=TABLES):
+    db = Database()
+    db.init_db()
+    for table in tables:
+        start = time.time()
+        rows = import_table(db, table, directory)
+        print('Imported {} ({:,} rows) in {}.'.format(
+            table, rows, seconds_to_dhms(time.time()-start)))
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if len(args) < 2 or args[0] not in ('export', 'import'):
+        print(__doc__)
+        sys.exit(1)
+    tables = args[2:] or TABLES
+    if args[0] == 'export':
+        export_snapshot(args[1], tables)
+    else:
+        import_snapshot(args[1], tables)
@@ -1,62 +1,102 @@
-from database import Database
+'''
+Dataset statistics.
 
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
+Histograms come from the materialized views of Database.refresh_stats,
+one query each. Run directly to refresh them and plot graphs/.
+'''
+import numpy as np
 
-plt.figure(num=None, figsize=(14,5), dpi=300, facecolor='w', edgecolor='k')
+try:
+    from .database import Database
+except ImportError:
+    from database import Database
 
 
+def distribution(pairs):
+    '''
+    Takes (value, quantity) pairs sorted by value.
+    Returns a dict of the values, quantities, and their cumulative sums,
+    both of quantities and of value * quantity (e.g. total favs).
+    '''
+    values = np.array([p[0] for p in pairs], dtype=np.int64)
+    counts = np.array([p[1] for p in pairs], dtype=np.int64)
+    return {
+        'values': values.tolist(),
+        'counts': counts.tolist(),
+        'cumulative_counts': np.cumsum(counts).tolist(),
+        'cumulative_totals': np.cumsum(values * counts).tolist(),
+    }
 
-db = Database()
 
-max_favs = 1000
+def all_stats(db=None):
+    '''
+    Returns the distributions of post favcounts,
+    user favorite counts (degrees) and tag post counts.
+    '''
+    db = db or Database()
+    return {
+        'favcount': distribution(db.get_histogram('stats_favcount')),
+        'user_degree': distribution(db.get_histogram('stats_user_degree')),
+        'tag_count': distribution(db.get_histogram('stats_tag_count')),
+    }
 
-# index corresponds to fav_count
-post_counts = []
-post_favs = []
 
-for f in range(max_favs + 1):
-    count = db.get_favcount_stats(f)
-    favs = count * f
-    print('{} posts with {} total favs for favcount {}'.format(count, favs, f))
-    post_counts.append(count)
-    post_favs.append(favs)
+def dense(dist, key, max_value):
+    '''
+    Spreads a distribution's key over 0..max_value, for plotting.
+    '''
+    out = np.zeros(max_value + 1, dtype=np.int64)
+    values = np.array(dist['values'], dtype=np.int64)
+    keep = values <= max_value
+    out[values[keep]] = np.array(dist[key], dtype=np.int64)[keep]
+    return out
 
-# cumulative counts (owo)
-def accumulate(in_list):
-    cum = [in_list[0]]
-    for i in in_list[1:]:
-        cum.append(i + cum[-1])
-    return cum
 
-post_counts_cum = accumulate(post_counts)
-post_favs_cum = accumulate(post_favs)
+def plot(stats, max_favs=1000, path='graphs/'):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
 
-plt.grid(True)
-plt.plot(post_favs_cum)
-plt.ylabel('cumulative favs')
-plt.xlabel('post favcount')
-plt.savefig('graphs/cum_favs.png')
+    plt.figure(num=None, figsize=(14,5), dpi=300, facecolor='w', edgecolor='k')
 
-plt.clf()
-plt.grid(True)
-plt.plot(post_favs)
-plt.ylabel('favs by favcount')
-plt.xlabel('post favcount')
-plt.savefig('graphs/favs.png')
+    post_counts = dense(stats['favcount'], 'counts', max_favs)
+    post_favs = post_counts * np.arange(max_favs + 1)
+    post_counts_cum = np.cumsum(post_counts)
+    post_favs_cum = np.cumsum(post_favs)
 
-plt.clf()
-plt.grid(True)
-plt.plot(post_counts_cum)
-plt.ylabel('cumulative posts')
-plt.xlabel('post favcount')
-plt.savefig('graphs/cum_posts.png')
+    plt.grid(True)
+    plt.plot(post_favs_cum)
+    plt.ylabel('cumulative favs')
+    plt.xlabel('post favcount')
+    plt.savefig(path + 'cum_favs.png')
 
+    plt.clf()
+    plt.grid(True)
+    plt.plot(post_favs)
+    plt.ylabel('favs by favcount')
+    plt.xlabel('post favcount')
+    plt.savefig(path + 'favs.png')
 
-plt.clf()
-plt.grid(True)
-plt.plot(post_counts)
-plt.ylabel('posts by favcount')
-plt.xlabel('post favcount')
-plt.savefig('graphs/posts.png')
+    plt.clf()
+    plt.grid(True)
+    plt.plot(post_counts_cum)
+    plt.ylabel('cumulative posts')
+    plt.xlabel('post favcount')
+    plt.savefig(path + 'cum_posts.png')
+
+    plt.clf()
+    plt.grid(True)
+    plt.plot(post_counts)
+    plt.ylabel('posts by favcount')
+    plt.xlabel('post favcount')
+    plt.savefig(path + 'posts.png')
+
+
+def main():
+    db = Database()
+    db.refresh_stats()
+    plot(all_stats(db))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+'''
+Tag-based similarity.
+
+Posts are represented as TF-IDF vectors over their tags (from post_tags),
+normalized so that dot products are cosine similarities. The transposed
+matrix serves as an inverted index: scoring a post only visits the posts
+sharing at least one of its tags.
+
+Needs no favorites, so it also covers posts below MIN_FAVS.
+
+Building the index scans all of post_tags, so it can be built once and
+saved for web workers to load (see TAG_INDEX_FILE).
+
+Usage:
+    python tagsim.py write <path>   build the index and save it
+'''
+import sys
+import time
+import threading
+import itertools
+
+import numpy as np
+from scipy import sparse
+
+try:
+    from .database import Database
+    from .utilities import *
+    from . import constants
+except ImportError:
+    from database import Database
+    from utilities import *
+    import constants
+
+
+class TagIndex():
+    '''
+    Sparse TF-IDF matrix of posts by tags, with its inverted index.
+    '''
+    def __init__(self, post_ids, tag_ids, matrix, idf=None):
+        '''
+        matrix holds the tags of each post, or if idf is given,
+        the weighted and normalized vectors of a saved index.
+        '''
+        self.post_ids = np.asarray(post_ids)
+        self.post_rows = {id: i for i, id in enumerate(self.post_ids.tolist())}
+        self.tag_ids = np.asarray(tag_ids)
+        self.tag_cols = {id: i for i, id in enumerate(self.tag_ids.tolist())}
+
+        if idf is None:
+            df = np.bincount(matrix.indices, minlength=matrix.shape[1])
+            idf = np.log(matrix.shape[0] / np.maximum(df, 1)).astype(np.float32)
+            if constants.TAG_MAX_DF < 1:
+                # tags on most posts say little and make the index slow
+                idf[df > constants.TAG_MAX_DF * matrix.shape[0]] = 0
+            matrix = self._normalize(matrix @ sparse.diags(idf))
+
+        self.idf = idf
+        self.matrix = matrix
+        self.inverted = self.matrix.T.tocsr()
+
+    @staticmethod
+    def _normalize(m):
+        m = sparse.csr_matrix(m, dtype=np.float32)
+        m.eliminate_zeros()
+        norms = np.sqrt(np.asarray(m.multiply(m).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        return sparse.csr_matrix(sparse.diags(1 / norms) @ m)
+
+    @classmethod
+    def build(cls, db, itersize=constants.STREAM_ITERSIZE):
+        '''
+        Builds the index from post_tags, streaming it (see Database.stream).
+        Pairs are kept as int32 arrays, a chunk at a time.
+        '''
+        start = time.time()
+        post_chunks = [np.zeros(0, dtype=np.int32)]
+        tag_chunks = [np.zeros(0, dtype=np.int32)]
+
+        pairs = db.stream('''select post_id, tag_id from post_tags''',
+                          itersize=itersize)
+        while True:
+            chunk = list(itertools.islice(pairs, itersize))
+            if not chunk:
+                break
+            chunk = np.array(chunk, dtype=np.int32)
+            post_chunks.append(chunk[:, 0])
+            tag_chunks.append(chunk[:, 1])
+
+        post_ids, rows = np.unique(np.concatenate(post_chunks), return_inverse=True)
+        del post_chunks
+        tag_ids, cols = np.unique(np.concatenate(tag_chunks), return_inverse=True)
+        del tag_chunks
+
+        matrix = sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.float32), (rows, cols)),
+            shape=(len(post_ids), len(tag_ids)))
+        index = cls(post_ids, tag_ids, matrix)
+        print('Built tag index: {:,} posts, {:,} tags in {}.'.format(
+            len(post_ids), len(tag_ids), seconds_to_dhms(time.time()-start)))
+        return index
+
+    def save(self, path):
+        '''
+        Writes the index to an .npz file, for load.
+        '''
+        # written through a file object, so numpy keeps the path as given
+        with open(path, 'wb') as f:
+            np.savez(f, post_ids=self.post_ids, tag_ids=self.tag_ids, idf=self.idf,
+                     data=self.matrix.data, indices=self.matrix.indices,
+                     indptr=self.matrix.indptr, shape=self.matrix.shape)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Reads an index written by save.
+        '''
+        start = time.time()
+        with np.load(path) as f:
+            matrix = sparse.csr_matrix((f['data'], f['indices'], f['indptr']),
+                                       shape=tuple(f['shape']))
+            index = cls(f['post_ids'], f['tag_ids'], matrix, idf=f['idf'])
+        print('Loaded tag index: {:,} posts, {:,} tags in {}.'.format(
+            len(index.post_ids), len(index.tag_ids), seconds_to_dhms(time.time()-start)))
+        return index
+
+    def vector(self, post_id, db=None):
+        '''
+        Returns the normalized tag vector of a post as a 1 x tags matrix.
+        Posts newer than the index are looked up in the database.
+        '''
+        if post_id in self.post_rows:
+            return self.matrix[self.post_rows[post_id]]
+
+        cols = []
+        if db is not None:
+            db.c.execute('''select tag_id from post_tags where post_id = %s''',
+                         (post_id,))
+            cols = [self.tag_cols[t[0]] for t in db.c.fetchall()
+                    if t[0] in self.tag_cols]
+        v = sparse.csr_matrix(
+            (self.idf[cols], ([0]*len(cols), cols)),
+            shape=(1, len(self.tag_cols)))
+        return self._normalize(v)
+
+    def similar(self, post_id, n=constants.SIM_PER_POST, db=None):
+        '''
+        Returns (ids, scores) of the n posts whose tags are most similar.
+        '''
+        v = self.vector(post_id, db)
+        if not v.nnz:
+            return [], []
+
+        # accumulate over the posting lists of the post's tags only
+        scores = (sparse.csr_matrix(v.data) @ self.inverted[v.indices]).tocoo()
+        ids = self.post_ids[scores.col]
+        values = scores.data
+
+        keep = ids != post_id
+        ids, values = ids[keep], values[keep]
+        if len(ids) > n:
+            top = np.argpartition(-values, n)[:n]
+            ids, values = ids[top], values[top]
+        order = np.argsort(-values)
+        return ids[order].tolist(), values[order].tolist()
+
+    def scores_for(self, post_id, candidate_ids, db=None):
+        '''
+        Returns the tag similarity of the post with each candidate.
+        Candidates absent from the index score 0.
+        '''
+        v = self.vector(post_id, db)
+        rows = [self.post_rows.get(id, -1) for id in candidate_ids]
+        present = [r for r in rows if r >= 0]
+        scores = np.zeros(len(rows), dtype=np.float32)
+        if present and v.nnz:
+            found = np.asarray((self.matrix[present] @ v.T).todense()).ravel()
+            scores[[i for i, r in enumerate(rows) if r >= 0]] = found
+        return scores.tolist()
+
+
+_index = None
+_index_lock = threading.Lock()
+
+def get_index(rebuild=False):
+    '''
+    Returns this process's tag index, on first use loading it from
+    TAG_INDEX_FILE if set, or else building it. Threads asking meanwhile
+    wait for it rather than each building their own.
+    '''
+    global _index
+    if _index is None or rebuild:
+        with _index_lock:
+            if _index is None or rebuild:
+                if constants.TAG_INDEX_FILE and not rebuild:
+                    _index = TagIndex.load(constants.TAG_INDEX_FILE)
+                else:
+                    _index = TagIndex.build(Database())
+    return _index
+
+
+def tag_similar(source_id, n=constants.SIM_PER_POST):
+    '''
+    Returns ids of the n posts most similar to the source by tags.
+    '''
+    db = Database()
+    ids, scores = get_index().similar(source_id, n, db)
+    return ids
+
+
+def blend(source_id, fav_rows, weight=constants.TAG_SIM_WEIGHT,
+          n=constants.SIM_PER_POST, metric=None):
+    '''
+    Ranks candidates by a weighted blend of favorites and tag similarity.
+
+    fav_rows are sym_similarity rows involving the source, as returned by
+    Database.select_n_similar, scored by metric (SYM_SIM_MODE by default).
+    Tag candidates are added to them.
+    Each score is scaled by its best candidate before blending, since
+    favorites similarities are much smaller than tag cosines.
+    Returns the ids of the top n.
+    '''
+    db = Database()
+    index = get_index()
+
+    fav_scores = {}
+    for r, score in zip(fav_rows, db.score_sym_rows(fav_rows, metric)):
+        other = r[1] if r[0] == source_id else r[0]
+        fav_scores[other] = score
+
+    tag_ids, tag_scores = index.similar(source_id, n*4, db)
+    candidates = list(set(fav_scores) | set(tag_ids))
+    if not candidates:
+        return []
+
+    fav = np.array([fav_scores.get(id, 0) for id in candidates], dtype=np.float32)
+    tag = np.array(index.scores_for(source_id, candidates, db), dtype=np.float32)
+    fav /= max(fav.max(), 1e-9)
+    tag /= max(tag.max(), 1e-9)
+
+    blended = (1 - weight) * fav + weight * tag
+    order = np.argsort(-blended)[:n]
+    return [candidates[i] for i in order]
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if len(args) > 1 and args[0] == 'write':
+        TagIndex.build(Database()).save(args[1])
+    else:
+        print(__doc__)
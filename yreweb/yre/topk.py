@@ -0,0 +1,108 @@
+'''
+Fixed-width top-K storage of similars.
+
+post_similars_packed holds one row per post (see Database.write_similar_row).
+For read-only serving, it can also be written out as a memory-mapped
+N x SIM_PER_POST int32 file, where row i holds the similars of post i,
+so a lookup is an array index.
+
+Usage:
+    python topk.py pack           fill post_similars_packed from post_similars
+    python topk.py write <path>   write the memory-mapped file
+    python topk.py bench [n]      compare read latency of each layout
+'''
+import sys
+import time
+import random
+
+import numpy as np
+
+try:
+    from .database import Database
+    from .utilities import *
+    from . import constants
+except ImportError:
+    from database import Database
+    from utilities import *
+    import constants
+
+
+def write_topk_file(path, itersize=constants.STREAM_ITERSIZE):
+    '''
+    Writes post_similars_packed to a memory-mappable N x K int32 file.
+    Posts without similars are rows of zeros.
+    '''
+    start = time.time()
+    db = Database()
+    db.c.execute('''select max(source_id) from post_similars_packed''')
+    n = (db.c.fetchall()[0][0] or 0) + 1
+    k = constants.SIM_PER_POST
+
+    table = np.lib.format.open_memmap(path, mode='w+', dtype=np.int32, shape=(n, k))
+
+    for source_id, sim_posts in db.stream(
+            '''select source_id, sim_posts from post_similars_packed''',
+            itersize=itersize):
+        row = sim_posts[:k]
+        table[source_id, :len(row)] = row
+
+    table.flush()
+    print('Wrote {} x {} top-k file in {}.'.format(
+        n, k, seconds_to_dhms(time.time()-start)))
+
+
+_table = None
+
+def lookup(post_id, path=None):
+    '''
+    Returns the similars of a post from the memory-mapped file
+    (TOPK_FILE by default), or None if it has none.
+    '''
+    global _table
+    if _table is None:
+        _table = np.load(path or constants.TOPK_FILE, mmap_mode='r')
+    if post_id >= len(_table) or not _table[post_id].any():
+        return None
+    return _table[post_id].tolist()
+
+
+def read_benchmark(samples=1000, path=None):
+    '''
+    Compares the latency of reading one post's similars
+    from post_similars, post_similars_packed and the top-k file.
+    '''
+    db = Database()
+    db.c.execute('''select source_id from post_similars_packed''')
+    ids = [r[0] for r in db.c.fetchall()]
+    ids = random.sample(ids, min(samples, len(ids)))
+    if not ids:
+        print('No packed similars to read.')
+        return
+
+    readers = [('rows', db.select_similars),
+               ('packed', db.select_similars_packed)]
+    if path or constants.TOPK_FILE:
+        readers.append(('mmap', lambda id: lookup(id, path)))
+
+    for name, read in readers:
+        times = []
+        for id in ids:
+            start = time.perf_counter()
+            read(id)
+            times.append(time.perf_counter() - start)
+        times = np.array(times) * 1000
+        print('{:7s} mean {:7.4f}ms  p50 {:7.4f}ms  p99 {:7.4f}ms  ({} reads)'.format(
+            name, times.mean(), np.percentile(times, 50),
+            np.percentile(times, 99), len(times)))
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if args and args[0] == 'pack':
+        Database().pack_similars()
+    elif len(args) > 1 and args[0] == 'write':
+        write_topk_file(args[1])
+    elif args and args[0] == 'bench':
+        read_benchmark(int(args[1]) if len(args) > 1 else 1000)
+    else:
+        print(__doc__)